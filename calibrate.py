@@ -0,0 +1,140 @@
+# calibrate.py
+#
+# A script to calibrate a hyperspectral image against dark and white
+# reference images, using the formula from clicker.py:
+#
+#  Corrected Image = (Raw - Dark) / (White - Dark)
+#
+# Simon Parsons
+# October 2026
+#
+# Borrowing from:
+# https://www.spectralpython.net
+# https://www.geeksforgeeks.org/command-line-arguments-in-python/
+
+# Note that if you use the default output file, this will be in the
+# same directory as the original file --- if you need to specify a
+# different location, use the -o/--Output option to give the path.
+
+import sys
+import getopt
+import spectral as sp
+import utils
+
+#
+# Print help message.
+#
+def displayHelp():
+    print("calibrate.py expects to be run in the following modes:")
+    print("1) python calibrate.py -h or python calibrate.py --Help, which displays this message.")
+    print("2) python calibrate.py -i <filename> -d <dark> -w <white>, or python calibrate.py --Input <filename> --Dark <dark> --White <white> which generates a new, calibrated, file <filename>-calibrated")
+    print("3) Using -o <new-name> or --Output <new-name> writes the calibrated image to <new-name> instead.")
+    print("4) Using -e <extension> or --Extension <extension> allows us to give an extension for the image file other than the default .img")
+    print("5) Using -g or --Gain applies the gain values in each header to that image before calibrating.")
+    print("6) Using -b <rows> or --Block <rows> sets how many image rows are calibrated at a time (default " + str(utils.gainBlockRows) + ").")
+    print("7) Using -m <size> or --MaxMemory <size> picks the number of rows to calibrate at a time so that no more than <size> (for example 512M or 2G) of memory is used for the image data.")
+    print("In all cases <filename>, <dark> and <white> should be hyperspectral image header files. <dark> and <white> need the same number of columns and bands as <filename>, but can have any number of rows.")
+
+
+def main():
+    # Set flags
+    help = False
+    inputFile = False
+    darkFile = False
+    whiteFile = False
+    outputFile = False
+    extension = False
+    gain = False
+    maxMemory = False
+    blockRows = utils.gainBlockRows
+    # Drop the filename from the list of command line arguments
+    argList = sys.argv[1:]
+
+    # We support help, input, dark, white, output, extension, gain,
+    # block and max memory. All but help and gain have associated
+    # values.
+    options = "hi:d:w:o:e:gb:m:"
+
+    # Long options.
+    long_options = ["Help", "Input=", "Dark=", "White=", "Output=", "Extension=",
+                    "Gain", "Block=", "MaxMemory="]
+
+    try:
+        # Parsing argument
+        arguments, values = getopt.getopt(argList, options, long_options)
+
+        # Checking each argument. Note that currentValue is only
+        # instantiated if the argument was previously specified to
+        # take a value.
+        for currentArgument, currentValue in arguments:
+            if currentArgument in ("-h", "--Help"):
+                help = True
+                displayHelp()
+
+            # Identifies the header file of the image to calibrate
+            elif currentArgument in ("-i", "--Input"):
+                inputFile = True
+                fileName = currentValue
+
+            # The dark reference
+            elif currentArgument in ("-d", "--Dark"):
+                darkFile = True
+                darkName = currentValue
+
+            # The white reference
+            elif currentArgument in ("-w", "--White"):
+                whiteFile = True
+                whiteName = currentValue
+
+            # Specifies the output file name Must have an .hdr
+            # extension. The image file defualts to .img
+            elif currentArgument in ("-o", "--Output"):
+                outputFile = True
+                outName = currentValue
+
+            # If we want to specify the extension of the image file
+            elif currentArgument in ("-e", "--Extension"):
+                extension = True
+                extensionName = currentValue
+
+            # Apply the gain to each image first
+            elif currentArgument in ("-g", "--Gain"):
+                gain = True
+
+            # The number of rows to calibrate in one go
+            elif currentArgument in ("-b", "--Block"):
+                blockRows = int(currentValue)
+
+            # The memory budget
+            elif currentArgument in ("-m", "--MaxMemory"):
+                maxMemory = True
+                memorySize = utils.parseMemorySize(currentValue)
+
+        # Now process the image so long as we have specified the
+        # image and both references. If we have specified help, then
+        # we do no processing.
+        if (not help) and inputFile and darkFile and whiteFile:
+            if not outputFile:
+                outName = utils.calibratedName(fileName)
+
+            # Image file extension is handled by the spectral
+            # package so pass the info along.
+            outputArgs = {}
+            if extension:
+                outputArgs['ext'] = extensionName
+
+            if maxMemory:
+                blockRows = utils.blockRowsForMemory(utils.getImage(fileName), memorySize)
+            utils.calibrateFile(fileName, darkName, whiteName, outName, blockRows,
+                                gain, **outputArgs)
+
+        elif not help:
+            print("Need to specify an image and both dark and white references")
+            displayHelp()
+
+    except getopt.error as err:
+        # output error, and return with an error code
+        print (str(err))
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,10 @@
 
 import sys
 import getopt
+import os
+import glob
+import time
+import numpy as np
 import spectral as sp
 #import my_hacked_envi
 import utils
@@ -34,7 +38,14 @@ def displayHelp():
     print("2) python convert.py -c <filename>, or python convert.py --Convert  <filename> which generates a new, gain converted, file <filename>-gain-adjusted")
     print("3) python convert.py -c <filename> -o <new-name> or python convert.py --Convert <filename> ---Output <new-name> which generates a new, gain converted, file <new-name>")
     print("4) Using -e <extension> or --Extension <extension> allows us to give an extension for the image file other than the default .img")
-    print("In all cases <filename> should be a hyperspectral image header file.")
+    print("5) Using -b <rows> or --Block <rows> sets how many image rows are gain adjusted at a time (default " + str(utils.gainBlockRows) + "). Bigger blocks are faster but use more memory.")
+    print("6) Using -m <size> or --MaxMemory <size> streams the conversion: blocks of rows are adjusted and written straight into the new file, with the block size picked so that no more than <size> (for example 512M or 2G) of memory is used for the image data.")
+    print("7) Using -w <n> or --Workers <n> splits the image into <n> ranges of rows which are converted in parallel by <n> processes, all writing into the same new file. The memory budget given by -m is shared between the workers. The time taken and throughput (MB/s) are reported at the end.")
+    print("8) Using -t <type> or --Type <type> sets the data type of the new image. <type> is one of: " + ", ".join(utils.gainOutputTypes) + ". The default is float32; uint16 stores scaled integers in half the space, and records the scale in the header as the reflectance scale factor.")
+    print("9) Using -s <scale> or --Scale <scale> with -t uint16 sets the scale factor. If not given, the scale is chosen so that the largest value in the image fits.")
+    print("10) python convert.py -c <directory> or python convert.py -c \"<pattern>\" converts every .hdr file in <directory>, or every file matching a pattern like \"raw-data-240924/*.hdr\", each into its own <filename>-gain-adjusted file. -w <n> converts <n> files at a time. Files whose converted version is newer than the original and was made with the same gain, type and scale are skipped, unless -f or --Force is given. A summary of the time taken for each file is printed at the end.")
+    print("11) Using -k or --Cache keeps the converted image in a cache directory (see utils.py), and if the same file has been converted in the same way before, just copies the cached version.")
+    print("In all other cases <filename> should be a hyperspectral image header file.")
           
           
 def main():
@@ -43,15 +54,26 @@ def main():
     inputFile = False
     outputFile = False
     extension = False
+    blockRows = utils.gainBlockRows
+    maxMemory = False
+    workers = 1
+    outputType = 'float32'
+    scale = None
+    force = False
+    cache = False
     # Drop the filename from the list of command line arguments
     argList = sys.argv[1:]
           
-    # We support help, convert, output and extension. Convert, output
-    # and extension have associated values.
-    options = "hc:o:e:"
+    # We support help, convert, output, extension, block, max memory,
+    # workers, type, scale, force and cache. All but help, force and
+    # cache have associated values.
+    options = "hc:o:e:b:m:w:t:s:fk"
           
     # Long options. Again Convert and Output take values.
-    long_options = ["Help", "Convert=", "Output=", "Extension="]
+    long_options = ["Help", "Convert=", "Output=", "Extension=", "Block=",
+                    "MaxMemory=", "Workers=",
+                    "Type=", "Scale=", "Force",
+                    "Cache"]
           
     try:
         # Parsing argument
@@ -81,23 +103,96 @@ def main():
                 extension = True
                 extensionName = currentValue
           
+            # The number of rows to gain adjust in one go
+            elif currentArgument in ("-b", "--Block"):
+                blockRows = int(currentValue)
+          
+            # The memory budget for a streaming conversion
+            elif currentArgument in ("-m", "--MaxMemory"):
+                maxMemory = True
+                memorySize = utils.parseMemorySize(currentValue)
+          
+            # The number of processes to convert with
+            elif currentArgument in ("-w", "--Workers"):
+                workers = int(currentValue)
+          
+            # The data type of the new image
+            elif currentArgument in ("-t", "--Type"):
+                outputType = currentValue.lower()
+          
+            # The scale factor for uint16 images
+            elif currentArgument in ("-s", "--Scale"):
+                scale = float(currentValue)
+          
+            # Convert files in a batch even if they are up to date
+            elif currentArgument in ("-f", "--Force"):
+                force = True
+          
+            # Use the cache of converted images
+            elif currentArgument in ("-k", "--Cache"):
+                cache = True
+          
         # Now process the image so long as we have at least specified
         # an input file. If we have specified help, then we do no
         # processing.
         if (not help) and inputFile:
-            adjustedImage = utils.gainAdjustFile(fileName)
-            if outputFile:
-                if extension:
-                    # Image file extension is handled by the spectral
-                    # package so pass the info along.
-                    utils.outputFile(outName, adjustedImage, ext=extensionName)
-                else:
-                    utils.outputFile(outName, adjustedImage)
+            if not outputFile:
+                outName = utils.gainAdjustedName(fileName)
+
+            # Image file extension is handled by the spectral
+            # package so pass the info along.
+            outputArgs = {}
+            if extension:
+                outputArgs['ext'] = extensionName
+
+            if outputType not in utils.gainOutputTypes:
+                print("Unknown output type " + outputType)
+                displayHelp()
+            elif scale is not None and outputType != 'uint16':
+                print("A scale (-s) can only be used with -t uint16")
+                displayHelp()
+            elif os.path.isdir(fileName) or glob.has_magic(fileName):
+                # A whole batch of files, converted a file at a time
+                # by each of the workers.
+                files = utils.findHeaderFiles(fileName)
+                if maxMemory and files:
+                    blockRows = utils.blockRowsForMemory(utils.getImage(files[0]), memorySize // workers)
+                start = time.time()
+                results = utils.batchGainAdjustFiles(files, workers, blockRows, outputType,
+                                                     scale, force, **outputArgs)
+                utils.printBatchSummary(results)
+                size = sum(result[3] for result in results if result[1] == 'converted')
+                utils.reportThroughput(size, start)
+            elif cache:
+                # Pick up the converted image from the cache, making
+                # it first if need be.
+                if maxMemory:
+                    blockRows = utils.blockRowsForMemory(utils.getImage(fileName), memorySize)
+                path = utils.cachedGainAdjustedFile(fileName, blockRows, outputType, scale)
+                utils.copyFromCache(path, outName, **outputArgs)
+            elif workers > 1:
+                # Each worker writes its own rows into the new file.
+                image = utils.getImage(fileName)
+                if maxMemory:
+                    blockRows = utils.blockRowsForMemory(image, memorySize // workers)
+                start = time.time()
+                utils.parallelGainAdjustFile(fileName, outName, workers, blockRows,
+                                             outputType, scale, **outputArgs)
+                utils.reportThroughput(utils.imageBytes(image), start)
+            elif maxMemory or outputType != 'float32':
+                # Write each block into the new file as we go, using
+                # as many rows at a time as the memory budget allows.
+                if maxMemory:
+                    blockRows = utils.blockRowsForMemory(utils.getImage(fileName), memorySize)
+                utils.streamGainAdjustFile(fileName, outName, blockRows,
+                                           outputType, scale, **outputArgs)
             else:
-                if extension:
-                    utils.outputFile(fileName[:-4] + '-gain-adjusted.hdr', adjustedImage, ext=extensionName)
-                else:
-                    utils.outputFile(fileName[:-4] + '-gain-adjusted.hdr', adjustedImage)
+                # The image is saved as float32, so there is no need
+                # to hold it as anything bigger.
+                adjustedImage = utils.gainAdjustFile(fileName, blockRows, np.float32)
+                gain = utils.getImage(fileName).bands.bandwidths
+                outputArgs['metadata'] = utils.gainMetadata(gain, 'float32')
+                utils.outputFile(outName, adjustedImage, **outputArgs)
                 
     except getopt.error as err:
         # output error, and return with an error code
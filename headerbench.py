@@ -0,0 +1,169 @@
+# headerbench.py
+#
+# A script to time the ENVI header parser in envi.py against the
+# version it replaced, on synthetic headers with long wavelength,
+# fwhm, data gain values and bbl lists. It also checks that both
+# versions give exactly the same dictionary.
+#
+# Simon Parsons
+# October 2026
+#
+# Borrowing from:
+# https://www.spectralpython.net
+# https://www.geeksforgeeks.org/command-line-arguments-in-python/
+
+# Note that this times whichever envi.py the spectral package is using,
+# so copy envi.py into the package first (see README.md).
+
+import sys
+import getopt
+import os
+import tempfile
+import time
+import spectral as sp
+
+#
+# Print help message.
+#
+def displayHelp():
+    print("headerbench.py expects to be run in the following modes:")
+    print("1) python headerbench.py -h or python headerbench.py --Help, which displays this message.")
+    print("2) python headerbench.py, which times both parsers on a header with 10000 entries in each list.")
+    print("3) Using -n <entries> or --Entries <entries> sets the number of entries in each list, and -r <repeats> or --Repeats <repeats> the number of times each parser is run (default 5, the best time is reported).")
+
+#
+# The parser from the original envi.py, reading the lines that follow
+# the "ENVI" line. Lines are popped from the front of the list and
+# brace blocks built up by string concatenation, which makes it
+# quadratic in the size of the header.
+#
+def legacyParse(lines):
+    dict = {}
+    while lines:
+        line = lines.pop(0)
+        if line.find('=') == -1: continue
+        if line[0] == ';': continue
+
+        (key, sep, val) = line.partition('=')
+        key = key.strip().lower()
+        val = val.strip()
+        if val and val[0] == '{':
+            str = val.strip()
+            while str[-1] != '}':
+                line = lines.pop(0)
+                if line[0] == ';': continue
+
+                str += '\n' + line.strip()
+            if key == 'description':
+                dict[key] = str.strip('{}').strip()
+            else:
+                vals = str[1:-1].split(',')
+                for j in range(len(vals)):
+                    vals[j] = vals[j].strip()
+                dict[key] = vals
+        else:
+            dict[key] = val
+    return dict
+
+#
+# As read_envi_header, but using legacyParse.
+#
+def legacyReadHeader(file):
+    with open(file, 'r') as f:
+        f.readline()
+        lines = f.readlines()
+    return legacyParse(lines)
+
+#
+# Write a synthetic header to file, with entries values in each of the
+# lists, and the lists split over lines as ENVI does.
+#
+def writeHeader(file, entries):
+    with open(file, 'w') as f:
+        f.write("ENVI\n")
+        f.write("description = {\n  Synthetic header for headerbench.py\n  with two lines}\n")
+        f.write("samples = 1024\nlines = 1024\nbands = %d\n" % entries)
+        f.write("header offset = 0\nfile type = ENVI Standard\ndata type = 12\n")
+        f.write("interleave = bil\nbyte order = 0\n")
+        f.write("; a comment line\n")
+        lists = {'wavelength': lambda i: "%.4f" % (400 + i * 0.05),
+                 'fwhm': lambda i: "%.4f" % (1 + (i % 7) * 0.01),
+                 'data gain values': lambda i: "%.6f" % (0.5 + (i % 13) * 0.1),
+                 'bbl': lambda i: str(i % 2)}
+        for name, value in lists.items():
+            f.write("%s = {\n" % name)
+            for start in range(0, entries, 8):
+                stop = min(start + 8, entries)
+                row = " , ".join(value(i) for i in range(start, stop))
+                if stop < entries:
+                    f.write(" " + row + ",\n")
+                else:
+                    f.write(" " + row + "}\n")
+
+#
+# Run parse on file repeats times and return the best time and the
+# result.
+#
+def timeParser(parse, file, repeats):
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = parse(file)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def main():
+    help = False
+    entries = 10000
+    repeats = 5
+
+    # Drop the filename from the list of command line arguments
+    argList = sys.argv[1:]
+
+    # We support help, entries and repeats. Entries and repeats have
+    # associated values.
+    options = "hn:r:"
+
+    # Long options.
+    long_options = ["Help", "Entries=", "Repeats="]
+
+    try:
+        # Parsing argument
+        arguments, values = getopt.getopt(argList, options, long_options)
+
+        for currentArgument, currentValue in arguments:
+            if currentArgument in ("-h", "--Help"):
+                help = True
+                displayHelp()
+
+            elif currentArgument in ("-n", "--Entries"):
+                entries = int(currentValue)
+
+            elif currentArgument in ("-r", "--Repeats"):
+                repeats = int(currentValue)
+
+        if not help:
+            with tempfile.TemporaryDirectory() as directory:
+                file = os.path.join(directory, 'bench.hdr')
+                writeHeader(file, entries)
+                size = os.path.getsize(file)
+                legacyTime, legacyResult = timeParser(legacyReadHeader, file, repeats)
+                newTime, newResult = timeParser(sp.envi.read_envi_header, file, repeats)
+
+            print("Header with %d entries per list (%d bytes)" % (entries, size))
+            print("Original parser: %.4f s" % legacyTime)
+            print("Current parser:  %.4f s" % newTime)
+            print("Speed up:        %.1fx" % (legacyTime / max(newTime, 1e-9)))
+            if legacyResult == newResult:
+                print("Both parsers give the same dictionary")
+            else:
+                print("The parsers give DIFFERENT dictionaries")
+
+    except getopt.error as err:
+        # output error, and return with an error code
+        print (str(err))
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,7 @@ import getopt
 import numpy as np
 import spectral as sp
 import matplotlib.pyplot as plt
+import utils
 
 #
 # Print help message.
@@ -32,103 +33,61 @@ def displayHelp():
     print("1) python hyper.py -h or python hyper.py --Help, which displays this message.")
     print("2) python hyper.py -p <frac> or python hyper.py --PCA frac, which does a PCA and then reduces to the set of eigenvalues that capture <frac> of the variataion.")
     print("3) python hyper.py -w or python hyper.py --Waveform, which computes the average intensity across the images at every wavelength.")
+    print("Adding -k or --Cache (before the other options) keeps the reduced images made by -p in a cache directory (see utils.py), so that the PCA only has to be done once for each image.")
+    print("Adding -g or --Gain (before the other options) applies the gain values in the headers to the image data as it is read, so there is no need to run convert.py first.")
+    print("Adding -n <workers> or --Workers <workers> (before the other options) splits the work on each image between <workers> processes. Images are read a block of rows at a time, so at most one block per process is in memory.")
     
 #
 # Use the spectral package to create a file object (data isn't loaded
-# until it is accessed. 
+# until it is accessed. If gain is True, the gain values in the header
+# are applied to the data as it is read (see utils.getImage).
 #
-def getImage(file):
-    return sp.open_image(file)
+def getImage(file, gain=False):
+    return utils.getImage(file, gain)
 
 #
-# Load a set of images and return them in an np array. Note that
-# "images" here are data objects representing images, rather than
-# images themselves.
+# Set up the images as a stack (see utils.ImageStack), which can be
+# indexed like a single array of shape (folder, file, row, column,
+# band) but doesn't load anything until it is used. Note that "images"
+# here are data objects representing images, rather than images
+# themselves.
 #
 # Note that this assumes that the files within each folder have the
 # same name, which was true for some of the development work, but
 # needs to be fixed before running this on more than one folder.
 #
-def loadAllImages(folders, fileNames):
-    images = np.empty(shape=(len(folders), len(fileNames)), dtype='object')
-    for i in range(len(folders)):
-        for j in range(len(fileNames)):
-            img = getImage(folders[i] + '/' + fileNames[j])
-            print(img.__class__)
-            print(img)
-            images[i][j] = img
+# Re-written (October 2026). This used to return an array of the image
+# objects, which extractPixelData then loaded in full, all at once.
+#
+def loadAllImages(folders, fileNames, gain=False):
+    images = utils.ImageStack(folders, fileNames, gain)
+    for i, j in images.indices():
+        print(images.file(i, j), images.image(i, j).shape)
 
-    # print(images)
     return images
 
 #
-# Get the pixel data from the relevant files identified by the image
-# objects.  rows and columns define the size of the array holding the
-# image objects, which in turn tells us how many images we are dealing
-# with.
+# A single "pixel" is a single value from the imageRows x imageColumns
+# and one of the bands. For example, we have a [0, 0] in the first and
+# (if it exists) the 200th band of the first image:
 #
-def extractPixelData(images):
-    rows = images.shape[0]
-    columns = images.shape[1]
-    arrays = np.empty(shape=(rows, columns), dtype='object')
-    for i in range(rows):
-        for j in range(columns):
-            arrays[i][j] = images[i][j].load()
-
-    # arrays[a][b] is a single hyperspectral image with dimension
-    # (arrays[a][b].shape[0], arrays[a][b].shape[1], arrays[a][b].shape[2]).
-    # 
-    # imageBands are the wavelengths, and at each wavelength there
-    # is an array of pixels that is imageRows x imageColumns in size.
-    # This is 1024 x 1024 for the camera we are using.
-    #
-    # A single "pixel" is a single value from the imageRows x imageColumns
-    # and one of the bands. For example, we have a [0, 0] in the first and
-    # (if it exists) the 200th band:
-    #
-    # pixel = arrays[0][0][:, :, 0][0, 0]
-    # pixel = arrays[0][0][:, :, 199][0, 0]
-
-    return arrays
-
-def summariseImages(arrays):
-    rows = arrays.shape[0]
-    columns = arrays.shape[1]
-    # A band is an array, the size of the images, that can be extracted from arrays as
-    # follows:
-    #
-    # band = arrays[0][0][:, :, 0]
-    #
-    # We want to sum over this to get the total intensity at that
-    # wavelength and then plot it as a line/signal...
-    #
-    # In other words, we want to summarise each image by plotting the
-    # average intensity of each of the bands.
-    #
-    # For each image...
+# pixel = images[0, 0, 0, 0, 0]
+# pixel = images[0, 0, 0, 0, 199]
+#
+# We want to summarise each image by plotting the average intensity of
+# each of the bands. The averages are worked out a block of rows at a
+# time (see utils.imageStats), using workers processes.
+#
+def summariseImages(images, workers=1):
+    rows = len(images.folders)
+    columns = len(images.fileNames)
     allIntensities = np.empty(shape=(rows, columns), dtype='object')
-    for i in range(rows):
-        # ...iterate over each of the N bands, computing the average
-        # intensity over the image at that wavelength. We pull the
-        # dimensions of arrays from the shape sttribute.
-        for j in range(columns):
-            numBands = arrays[i][j].shape[2]
-            # Give us some indication how we are doing
-            print("[", i, ",", j, "]", end='', flush=True)
-            band = []
-            intensities = []
-            for k in range(numBands):
-                intensity = 0
-                band = arrays[i][j][:, :, k]
-                rows = arrays[i][j].shape[0]
-                columns = arrays[i][j].shape[1]
-                for l in range(rows):
-                    for m in range(columns):
-                        intensity += band[l,m]
-
-                averageIntensity = (intensity/(rows * columns))[0]
-                intensities.append(averageIntensity)
-                allIntensities[i][j] = intensities
+    for i, j in images.indices():
+        # Give us some indication how we are doing
+        print("[", i, ",", j, "]", end='', flush=True)
+        stats = utils.imageStats(images.file(i, j), images.gain, workers=workers,
+                                 covariance=False)
+        allIntensities[i][j] = list(stats.mean)
     print("")
     return allIntensities
 
@@ -151,22 +110,25 @@ def plotIntensities(allIntensities):
 #
 # Analyse intensities at different wavelengths.
 #
-def plotIntensityWaveforms(folders, fileNames):
-    images = loadAllImages(folders, fileNames)
-    arrays = extractPixelData(images)
-    intensities = summariseImages(arrays)
+def plotIntensityWaveforms(folders, fileNames, gain=False, workers=1):
+    images = loadAllImages(folders, fileNames, gain)
+    intensities = summariseImages(images, workers)
     plotIntensities(intensities)
 
 #
-# Use the PCA code in the spectral analysis library to do a PCA.
+# Use the PCA code in the spectral analysis library to do a PCA. The
+# statistics the PCA needs are worked out a block of rows at a time
+# (see utils.imageStats), using workers processes, and passed to the
+# spectral package in place of the image.
 #
-def extractPComponents(images):
-    rows = images.shape[0]
-    columns = images.shape[1]
+def extractPComponents(images, workers=1):
+    rows = len(images.folders)
+    columns = len(images.fileNames)
     pc =  np.empty(shape=(rows, columns), dtype='object')
     for i in range(rows):
         for j in range(columns):
-            pc[i][j] = sp.principal_components(images[i][j])
+            stats = utils.imageStats(images.file(i, j), images.gain, workers=workers)
+            pc[i][j] = sp.principal_components(stats)
             print(len(pc[i][j].eigenvalues))
     return pc
 
@@ -190,35 +152,48 @@ def reducePComponents(pc, number):
 
 #
 # Use the spectral library to handle the transformation of data to use
-# the eigenvalues of a PC analysis.  Both pc and data have the same
-# dimensions.
+# the eigenvalues of a PC analysis, writing each transformed image to a
+# file (one for each input file) in the same directory. pc has one
+# entry for each image in images. The images are transformed a block
+# of rows at a time (see utils.transformImageToFile).
 #
-def transformData(pc, data):
-    rows = pc.shape[0]
-    columns = pc.shape[1]
-    transformed =  np.empty(shape=(rows, columns), dtype='object')
-    for i in range(rows):
-        for j in range(columns):
-            transformed[i][j] = pc[i][j].transform(data[i][j])
-            print("Here is the transformmed image")
-            print(transformed[i][j])
-            
-    return transformed
+def outputFiles(pc, images, folders, fileNames):
+    for i in range(len(folders)):
+        for j in range(len(fileNames)):
+            newName = fileNames[j][:-4] + '-reduced.hdr'
+            utils.transformImageToFile(pc[i][j].transform, images.image(i, j),
+                                       folders[i] + '/' + newName)
 
-def outputFiles(transformed, folders, fileNames):
+#
+# As the -p option in main, but each reduced image is kept in the cache
+# (see utils.py). If the same image has been reduced to the same number
+# of components before, the cached version is just copied into place,
+# and otherwise the PCA is done and the result added to the cache.
+#
+def cachedPCAnalysis(folders, fileNames, num, gain=False, workers=1):
     for i in range(len(folders)):
         for j in range(len(fileNames)):
+            file = folders[i] + '/' + fileNames[j]
+            key = utils.cacheKey(file, 'pca', num, gain)
+            path = utils.cacheLookup(key, '.hdr')
+            if path is None:
+                image = getImage(file, gain)
+                stats = utils.imageStats(file, gain, workers=workers)
+                pc = sp.principal_components(stats).reduce(num=num)
+                name = utils.newCacheImageName(key)
+                utils.transformImageToFile(pc.transform, image, name, force=True)
+                path = utils.publishCacheImage(key, name)
             newName = fileNames[j][:-4] + '-reduced.hdr'
-            sp.envi.save_image(folders[i] + '/' + newName, transformed[i][j], dtype=np.float32)
+            utils.copyFromCache(path, folders[i] + '/' + newName)
     
 #
 # Perform a principle components analysis on the images.
 #
 # Not currently used (main calls these functions directly)
 #
-def pcAnalysis(folders, fileNames, num):
-    images = loadAllImages(folders, fileNames)
-    pc = extractPComponents(images)
+def pcAnalysis(folders, fileNames, num, gain=False, workers=1):
+    images = loadAllImages(folders, fileNames, gain)
+    pc = extractPComponents(images, workers)
     pc_frac = reducePComponents(pc, num)
           
 def main():
@@ -248,15 +223,28 @@ def main():
     argList = sys.argv[1:]
 
     # Theoptions are help, display intensity over wavelengths and do a PCA analysis.
-    options = "hwp:"
+    options = "hgkn:wp:"
 
     # Long options
-    long_options = ["Help", "Waveform", "PCA="]
+    long_options = ["Help", "Gain", "Cache", "Workers=", "Waveform", "PCA="]
 
     try:
         # Parsing argument
         arguments, values = getopt.getopt(argList, options, long_options)
         print(arguments)
+
+        # Gain, cache and workers have to be known before any image
+        # is loaded, so look for them first.
+        gain = False
+        cache = False
+        workers = 1
+        for currentArgument, currentValue in arguments:
+            if currentArgument in ("-g", "--Gain"):
+                gain = True
+            elif currentArgument in ("-k", "--Cache"):
+                cache = True
+            elif currentArgument in ("-n", "--Workers"):
+                workers = int(currentValue)
         
         # checking each argument
         for currentArgument, currentValue in arguments:
@@ -265,18 +253,20 @@ def main():
             
             elif currentArgument in ("-w", "--Waveform"):
                 # Generate summary plot of intensity across wavebands.
-                plotIntensityWaveforms(folders, fileNames)
+                plotIntensityWaveforms(folders, fileNames, gain, workers)
 
             elif currentArgument in ("-p", "--PCA"):
                 # Carry out a PCA analysis and write the data to files
                 # (one for each input file) in the same directory. num
                 # is the number of pc components to use.
-                num =  int(arguments[0][1])
-                images = loadAllImages(folders, fileNames)
-                pc = extractPComponents(images)
-                pc_frac = reducePComponents(pc, num)
-                pc_transform = transformData(pc_frac, images)
-                outputFiles(pc_transform, folders, fileNames)
+                num =  int(currentValue)
+                if cache:
+                    cachedPCAnalysis(folders, fileNames, num, gain, workers)
+                else:
+                    images = loadAllImages(folders, fileNames, gain)
+                    pc = extractPComponents(images, workers)
+                    pc_frac = reducePComponents(pc, num)
+                    outputFiles(pc_frac, images, folders, fileNames)
     
     except getopt.error as err:
         # output error, and return with an error code
@@ -0,0 +1,139 @@
+# interleave.py
+#
+# A script to rewrite a hyperspectral image with a different
+# interleave (BIL, BIP or BSQ), or in native byte order, without
+# loading the whole image into memory.
+#
+# Simon Parsons
+# October 2026
+#
+# Borrowing from:
+# https://www.spectralpython.net
+# https://www.geeksforgeeks.org/command-line-arguments-in-python/
+
+# Note that if you use the default output file, this will be in the
+# same directory as the original file --- if you need to specify a
+# different location, use the -o/--Output option to give the path.
+
+import sys
+import getopt
+import spectral as sp
+import utils
+
+#
+# Print help message.
+#
+def displayHelp():
+    print("interleave.py expects to be run in the following modes:")
+    print("1) python interleave.py -h or python interleave.py --Help, which displays this message.")
+    print("2) python interleave.py -i <filename> -t <interleave>, or python interleave.py --Input <filename> --To <interleave> which generates a new file <filename>-<interleave> holding the same image with the new interleave.")
+    print("3) Using -o <new-name> or --Output <new-name> writes the new image to <new-name> instead.")
+    print("4) Using -e <extension> or --Extension <extension> allows us to give an extension for the image file other than the default .img")
+    print("5) Using -b <rows> or --Block <rows> sets how many image rows are copied at a time (default " + str(utils.gainBlockRows) + ").")
+    print("6) Using -m <size> or --MaxMemory <size> picks the number of rows to copy at a time so that no more than <size> (for example 512M or 2G) of memory is used for the image data.")
+    print("7) python interleave.py -i <filename> -n, or python interleave.py --Input <filename> --Native rewrites <filename> in place in the native byte order of this computer, if it isn't already, so that it no longer has to be converted every time it is read. The new image holds the same values, and -b and -m can be used as above.")
+    print("<filename> should be a hyperspectral image header file, and <interleave> one of bil, bip or bsq. BSQ is fastest for working with whole bands (RGB images, band statistics), BIP for working with the spectra of individual pixels (sampling, picking).")
+
+
+def main():
+    # Set flags
+    help = False
+    inputFile = False
+    gotInterleave = False
+    outputFile = False
+    extension = False
+    native = False
+    maxMemory = False
+    blockRows = utils.gainBlockRows
+    # Drop the filename from the list of command line arguments
+    argList = sys.argv[1:]
+
+    # We support help, input, to, output, extension, native, block
+    # and max memory. All but help and native have associated values.
+    options = "hi:t:o:e:nb:m:"
+
+    # Long options.
+    long_options = ["Help", "Input=", "To=", "Output=", "Extension=",
+                    "Native", "Block=", "MaxMemory="]
+
+    try:
+        # Parsing argument
+        arguments, values = getopt.getopt(argList, options, long_options)
+
+        # Checking each argument. Note that currentValue is only
+        # instantiated if the argument was previously specified to
+        # take a value.
+        for currentArgument, currentValue in arguments:
+            if currentArgument in ("-h", "--Help"):
+                help = True
+                displayHelp()
+
+            # Identifies the header file of the image to rewrite
+            elif currentArgument in ("-i", "--Input"):
+                inputFile = True
+                fileName = currentValue
+
+            # The new interleave
+            elif currentArgument in ("-t", "--To"):
+                gotInterleave = True
+                interleave = currentValue.lower()
+
+            # Specifies the output file name Must have an .hdr
+            # extension. The image file defualts to .img
+            elif currentArgument in ("-o", "--Output"):
+                outputFile = True
+                outName = currentValue
+
+            # If we want to specify the extension of the image file
+            elif currentArgument in ("-e", "--Extension"):
+                extension = True
+                extensionName = currentValue
+
+            # Rewrite the file in native byte order
+            elif currentArgument in ("-n", "--Native"):
+                native = True
+
+            # The number of rows to copy in one go
+            elif currentArgument in ("-b", "--Block"):
+                blockRows = int(currentValue)
+
+            # The memory budget
+            elif currentArgument in ("-m", "--MaxMemory"):
+                maxMemory = True
+                memorySize = utils.parseMemorySize(currentValue)
+
+        # Now process the image so long as we have an input file and
+        # either an interleave or native. If we have specified help,
+        # then we do no processing.
+        if (not help) and inputFile and native:
+            if maxMemory:
+                blockRows = utils.blockRowsForMemory(utils.getImage(fileName), memorySize)
+            if utils.nativeOrderFile(fileName, blockRows):
+                print("Rewrote " + fileName + " in native byte order")
+            else:
+                print(fileName + " is already in native byte order")
+
+        elif (not help) and inputFile and gotInterleave:
+            if not outputFile:
+                outName = utils.reinterleavedName(fileName, interleave)
+
+            # Image file extension is handled by the spectral
+            # package so pass the info along.
+            outputArgs = {}
+            if extension:
+                outputArgs['ext'] = extensionName
+
+            if maxMemory:
+                blockRows = utils.blockRowsForMemory(utils.getImage(fileName), memorySize)
+            utils.reinterleaveFile(fileName, outName, interleave, blockRows, **outputArgs)
+
+        elif not help:
+            print("Need to specify an input file and either an interleave or -n")
+            displayHelp()
+
+    except getopt.error as err:
+        # output error, and return with an error code
+        print (str(err))
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,8 @@ the data file has an unusual file extension that SPy can not identify.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import hashlib
+import json
 import logging
 import numpy as np
 import os
@@ -58,6 +60,14 @@ dtype_map = [('1', np.uint8),                   # unsigned byte
 envi_to_dtype = dict((k, np.dtype(v).char) for (k, v) in dtype_map)
 dtype_to_envi = dict(tuple(reversed(item)) for item in list(envi_to_dtype.items()))
 
+# Directory for the persistent header cache (see `read_envi_header_cached`).
+# The cache is disabled if this is None.
+header_cache_dir = os.environ.get('SPECTRAL_HEADER_CACHE', None)
+
+# Maximum number of bytes converted and written at a time when saving image
+# data (see `_write_image`).
+write_chunk_size = 16 * 1024 * 1024
+
 class EnviException(SpyException):
     '''Base class for ENVI file-related exceptions.'''
     pass
@@ -137,8 +147,15 @@ def read_envi_header(file):
     have_nonlowercase_param = False
     support_nonlowercase_params = spy.settings.envi_support_nonlowercase_params
     try:
-        while lines:
-            line = lines.pop(0)
+        # Single forward pass over the lines. Brace blocks spanning
+        # several lines are collected in a list and joined once, rather
+        # than by popping from the front of the list and concatenating
+        # strings, both of which are quadratic in the header size.
+        nlines = len(lines)
+        i = 0
+        while i < nlines:
+            line = lines[i]
+            i += 1
             if line.find('=') == -1: continue
             if line[0] == ';': continue
 
@@ -150,12 +167,16 @@ def read_envi_header(file):
                     key = key.lower()
             val = val.strip()
             if val and val[0] == '{':
-                str = val.strip()
-                while str[-1] != '}':
-                    line = lines.pop(0)
+                parts = [val]
+                last = val
+                while not last.endswith('}'):
+                    line = lines[i]
+                    i += 1
                     if line[0] == ';': continue
 
-                    str += '\n' + line.strip()
+                    last = line.strip()
+                    parts.append(last)
+                str = '\n'.join(parts)
                 if key == 'description':
                     dict[key] = str.strip('{}').strip()
                 else:
@@ -179,6 +200,70 @@ def read_envi_header(file):
         raise EnviHeaderParsingError()
 
 
+def _header_cache_file(path):
+    '''Returns the name of the header cache entry for header file `path`.'''
+    name = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return os.path.join(header_cache_dir, name + '.json')
+
+def _read_header_cache(file):
+    '''
+    Returns the header cache entry for `file`, or None.
+
+    An entry is only returned if it was made from a file with the same
+    path, size and modification time as `file` has now.
+    '''
+    if header_cache_dir is None:
+        return None
+    path = os.path.realpath(file)
+    try:
+        info = os.stat(path)
+        with builtins.open(_header_cache_file(path), 'r') as fin:
+            entry = json.load(fin)
+    except (OSError, ValueError):
+        return None
+    if entry.get('path') != path or entry.get('size') != info.st_size or \
+      entry.get('mtime') != info.st_mtime_ns:
+        return None
+    return entry
+
+def _write_header_cache(file, header, bands=None):
+    '''
+    Stores the parsed `header` dict (and optionally a dict of band info) for
+    `file` in the header cache. Failure to write the cache is not an error.
+    '''
+    if header_cache_dir is None:
+        return
+    path = os.path.realpath(file)
+    try:
+        info = os.stat(path)
+        entry = {'path': path, 'size': info.st_size, 'mtime': info.st_mtime_ns,
+                 'header': header, 'bands': bands}
+        os.makedirs(header_cache_dir, exist_ok=True)
+        cache_file = _header_cache_file(path)
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        with builtins.open(tmp_file, 'w') as fout:
+            json.dump(entry, fout)
+        os.replace(tmp_file, cache_file)
+    except (OSError, TypeError, ValueError):
+        logger.debug('Unable to write header cache entry for %s.' % path)
+
+def read_envi_header_cached(file):
+    '''
+    USAGE: hdr = read_envi_header_cached(file)
+
+    As `read_envi_header`, but if `header_cache_dir` is set, the parsed
+    header is kept in a persistent cache keyed by the path, size and
+    modification time of the file, and is only parsed again when one of
+    those changes.
+    '''
+    entry = _read_header_cache(file)
+    if entry is not None:
+        return entry['header']
+    h = read_envi_header(file)
+    _write_header_cache(file, h)
+    return h
+
+
 def gen_params(envi_header):
     '''
     Parse an envi_header to a `Params` object.
@@ -191,7 +276,7 @@ def gen_params(envi_header):
     '''
     if not isinstance(envi_header, dict):
         headerPath = find_file_path(envi_header)
-        h = read_envi_header(headerPath)
+        h = read_envi_header_cached(headerPath)
     else:
         h = envi_header
 
@@ -287,7 +372,11 @@ def open(file, image=None):
     '''
 
     header_path = find_file_path(file)
-    h = read_envi_header(header_path)
+    entry = _read_header_cache(header_path)
+    if entry is not None:
+        h = entry['header']
+    else:
+        h = read_envi_header(header_path)
     check_compatibility(h)
     p = gen_params(h)
 
@@ -319,9 +408,14 @@ def open(file, image=None):
     p.filename = image
 
     if h.get('file type') == 'ENVI Spectral Library':
-        # File is a spectral library
-        data = np.fromfile(p.filename, p.dtype, p.ncols * p.nrows)
-        data.shape = (p.nrows, p.ncols)
+        # File is a spectral library. The spectra are memory-mapped
+        # (copy-on-write, so the file itself is never changed), which
+        # means only the spectra that are used are read from disk.
+        if p.ncols * p.nrows == 0:
+            data = np.zeros((p.nrows, p.ncols), dtype=p.dtype)
+        else:
+            data = np.memmap(p.filename, dtype=p.dtype, mode='c',
+                             offset=p.offset, shape=(p.nrows, p.ncols))
         return SpectralLibrary(data, h, p)
 
     #  Create the appropriate object type for the interleave format.
@@ -340,17 +434,27 @@ def open(file, image=None):
     # SP's nasty hack to pull the gain information without rewriting
     # BandInfo and all. Replaced 'fwhm', which I did not need, with
     # 'data gain values' which I did.
+    #
+    # The band info is kept in the header cache along with the header, so
+    # that the values only need converting once.
 
-    if 'wavelength' in h:
-        try:
-            img.bands.centers = [float(b) for b in h['wavelength']]
-        except:
-            pass
-    if 'data gain values' in h:
-        try:
-            img.bands.bandwidths = [float(f) for f in h['data gain values']]
-        except:
-            pass
+    if entry is not None and entry.get('bands') is not None:
+        img.bands.centers = entry['bands']['centers']
+        img.bands.bandwidths = entry['bands']['bandwidths']
+    else:
+        if 'wavelength' in h:
+            try:
+                img.bands.centers = [float(b) for b in h['wavelength']]
+            except:
+                pass
+        if 'data gain values' in h:
+            try:
+                img.bands.bandwidths = [float(f) for f in h['data gain values']]
+            except:
+                pass
+        _write_header_cache(header_path, h,
+                            {'centers': img.bands.centers,
+                             'bandwidths': img.bands.bandwidths})
     img.bands.band_unit = h.get('wavelength units', None)
 
     if 'bbl' in h:
@@ -583,23 +687,19 @@ def _prepared_data_and_metadata(hdr_file, image, **kwargs):
         src_interleave = 'bip'
         if len(data.shape) == 2:
             data = data[:, :, np.newaxis]
-        swap = False
         metadata = {}    
     elif isinstance(image, SpyFile):
         if image.using_memmap is True:
             data = image._memmap
             src_interleave = {spy.BSQ: 'bsq', spy.BIL: 'bil',
                               spy.BIP: 'bip'}[image.interleave]
-            swap = image.swap
         else:
             data = image.load(dtype=image.dtype, scale=False)
             src_interleave = 'bip'
-            swap = False
         metadata = image.metadata.copy()
     else:
         data = image.load()
         src_interleave = 'bip'
-        swap = False
         if hasattr(image, 'metadata'):
             metadata = image.metadata.copy()
         else:
@@ -610,10 +710,12 @@ def _prepared_data_and_metadata(hdr_file, image, **kwargs):
     if hasattr(image, 'bands'):
         add_band_info_to_metadata(image.bands, metadata)
 
+    # The returned data are left in their source data type and byte order
+    # (and the transpose is only a view) so that no copy of the image is
+    # made here. Conversion to the data type and byte order given in the
+    # metadata is done a chunk at a time by `_write_image`.
     dtype = np.dtype(kwargs.get('dtype', data.dtype)).char
     _validate_dtype(dtype)
-    if dtype != data.dtype.char:
-        data = data.astype(dtype)
     metadata['data type'] = dtype_to_envi[dtype]
 
     interleave = kwargs.get('interleave', 'bip').lower()
@@ -624,9 +726,6 @@ def _prepared_data_and_metadata(hdr_file, image, **kwargs):
         data = data.transpose(interleave_transpose(src_interleave, interleave))
     metadata['interleave'] = interleave
     metadata['byte order'] = 1 if endian_out == 'big' else 0
-    if (endian_out == sys.byteorder and not data.dtype.isnative) or \
-      (endian_out != sys.byteorder and data.dtype.isnative):
-        data = data.byteswap()
 
     return data, metadata
 
@@ -674,6 +773,12 @@ def add_band_info_to_metadata(bands, metadata, overwrite=False):
 def _write_image(hdr_file, data, header, **kwargs):
     '''
     Write `data` as an ENVI file using the metadata in `header`.
+
+    `data` must already have the interleave given in `header` (it may be a
+    transposed view), but can be of any data type and byte order. Data are
+    converted to the header's data type and byte order and written
+    `write_chunk_size` bytes at a time, so saving an image only needs a
+    small, fixed amount of memory beyond the image itself.
     '''
     check_compatibility(header)
     force = kwargs.get('force', False)
@@ -682,12 +787,32 @@ def _write_image(hdr_file, data, header, **kwargs):
     (hdr_file, img_file) = check_new_filename(hdr_file, img_ext, force)
     write_envi_header(hdr_file, header, is_library=False)
     logger.debug('Saving', img_file)
-    # bufsize = data.shape[0] * data.shape[1] * np.dtype(dtype).itemsize
-    bufsize = data.shape[0] * data.shape[1] * data.dtype.itemsize
-    fout = builtins.open(img_file, 'wb', bufsize)
-    fout.write(tobytes(data))
+    dtype = np.dtype(envi_to_dtype[str(header['data type'])])
+    dtype = dtype.newbyteorder('>' if int(header['byte order']) == 1 else '<')
+    fout = builtins.open(img_file, 'wb')
+    chunk_bytes = write_chunk_size * data.dtype.itemsize // max(data.dtype.itemsize, dtype.itemsize)
+    for chunk in _iter_chunks(data, chunk_bytes):
+        np.ascontiguousarray(chunk, dtype=dtype).tofile(fout)
     fout.close()
 
+def _iter_chunks(data, max_bytes):
+    '''
+    Yields consecutive sub-arrays of `data` which, written out in turn,
+    give `data` in C order. Each is no bigger than `max_bytes`, unless it is
+    a single row of the last axis.
+    '''
+    if data.ndim <= 1 or data.nbytes <= max_bytes:
+        yield data
+        return
+    step = max_bytes // max(data[0].nbytes, 1)
+    if step == 0:
+        for i in range(data.shape[0]):
+            for chunk in _iter_chunks(data[i], max_bytes):
+                yield chunk
+    else:
+        for i in range(0, data.shape[0], step):
+            yield data[i:i + step]
+
 
 def create_image(hdr_file, metadata=None, **kwargs):
     '''
@@ -877,7 +1002,9 @@ class SpectralLibrary:
 
         `names` (list of str):
 
-            A length-`C` list of names corresponding to the spectra.
+            A length-`C` list of names corresponding to the spectra. If the
+            header gives no names, the spectra are numbered from 1, and the
+            list is only built when it is first used.
 
         `bands` (:class:`spectral.BandInfo`):
 
@@ -894,6 +1021,8 @@ class SpectralLibrary:
 
                 Array with shape `CxB`, where `C` is the number of spectra in
                 the library and `B` is the number of bands for each spectrum.
+                This may be a :class:`numpy.memmap`, as it is for libraries
+                opened with :func:`spectral.io.envi.open`; it is not copied.
 
             `header` (dict):
 
@@ -925,15 +1054,23 @@ class SpectralLibrary:
         if names is not None:
             if len(names) != n_spectra:
                 raise ValueError('Number of spectrum names does not match data')
-            self.names = names
-        else:
-            self.names = [str(i + 1) for i in range(n_spectra)]
+        self._names = names
         self.bands.band_unit = header.get('wavelength units', "<unspecified>")
         self.bands.band_quantity = "Wavelength"
         self.params = params
         self.metadata = header.copy()
         self.metadata['data ignore value'] = 'NaN'
 
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = [str(i + 1) for i in range(self.spectra.shape[0])]
+        return self._names
+
+    @names.setter
+    def names(self, names):
+        self._names = names
+
     def save(self, file_basename, description=None):
         '''
         Saves the spectral library to a library file.
@@ -949,7 +1086,9 @@ class SpectralLibrary:
                 Optional text description of the library.
 
         This method creates two files: `file_basename`.hdr and
-        `file_basename`.sli.
+        `file_basename`.sli. The spectra are converted to 32-bit float and
+        written `write_chunk_size` bytes at a time, so saving a large (or
+        memory-mapped) library does not need a full copy of it in memory.
         '''
         meta = self.metadata.copy()
         meta['samples'] = self.spectra.shape[1]
@@ -969,9 +1108,268 @@ class SpectralLibrary:
             meta['description'] = description
         write_envi_header(file_basename + '.hdr', meta, True)
         fout = builtins.open(file_basename + '.sli', 'wb')
-        self.spectra.astype('f').tofile(fout)
+        spectra = np.asarray(self.spectra)
+        chunk_bytes = write_chunk_size * spectra.dtype.itemsize // max(spectra.dtype.itemsize, 4)
+        for chunk in _iter_chunks(spectra, chunk_bytes):
+            np.ascontiguousarray(chunk, dtype='f').tofile(fout)
         fout.close()
 
+    def build_index(self, normalize=True, n_components=None, kdtree=False,
+                    block_size=65536):
+        '''
+        Builds an index for finding the library spectra nearest to other
+        spectra.
+
+        Arguments:
+
+            See :class:`SpectralLibraryIndex`.
+
+        Returns:
+
+            :class:`SpectralLibraryIndex`
+
+        The index can be kept and queried any number of times, e.g.::
+
+            index = lib.build_index(n_components=20)
+            (distances, indices) = index.query(spectra, k=5)
+            names = [[lib.names[i] for i in row] for row in indices]
+        '''
+        return SpectralLibraryIndex(self, normalize=normalize,
+                                    n_components=n_components, kdtree=kdtree,
+                                    block_size=block_size)
+
+class SpectralLibraryIndex:
+    '''
+    An index over the spectra of a :class:`SpectralLibrary`, answering
+    top-`k` nearest-spectrum queries for batches of spectra by either of two
+    distances:
+
+        `euclidean`:
+
+            Euclidean distance between spectra after each band has been
+            normalized (by the mean and standard deviation of that band over
+            the library) and, optionally, after projecting onto the leading
+            principal components of the normalized library.
+
+        `angle`:
+
+            The spectral angle (in radians) between spectra, which ignores
+            overall brightness. This is always computed on the full spectra.
+
+    By default distances are computed with a blocked brute-force kernel (one
+    matrix product per block of library and query spectra), which is exact
+    and needs memory in proportion to the block size only. A KD-tree can be
+    used instead; this requires scipy, and is only worthwhile when the
+    spectra have few dimensions, i.e. with `n_components` set.
+    '''
+
+    def __init__(self, library, normalize=True, n_components=None,
+                 kdtree=False, block_size=65536):
+        '''Creates an index over the spectra in a spectral library.
+
+        Arguments:
+
+            `library` (:class:`SpectralLibrary`):
+
+                The library to index. Its spectra are read `block_size` at a
+                time, so a memory-mapped library is never loaded whole.
+
+            `normalize` (bool, default True):
+
+                Whether to scale each band to zero mean and unit variance
+                over the library before computing Euclidean distances.
+
+            `n_components` (int):
+
+                Optional number of principal components onto which spectra
+                are projected before computing Euclidean distances.
+
+            `kdtree` (bool, default False):
+
+                Whether to answer queries with a KD-tree (scipy's cKDTree)
+                rather than by brute force.
+
+            `block_size` (int, default 65536):
+
+                Number of library spectra compared with each block of queries
+                at a time.
+        '''
+        spectra = library.spectra
+        (n_spectra, n_bands) = spectra.shape
+        self.library = library
+        self.n_bands = n_bands
+        self.block_size = max(1, int(block_size))
+        self.kdtree = kdtree
+
+        # Band statistics, accumulated a block at a time.
+        total = np.zeros(n_bands)
+        total_sq = np.zeros(n_bands)
+        for i in range(0, n_spectra, self.block_size):
+            block = np.asarray(spectra[i:i + self.block_size], dtype=np.float64)
+            total += block.sum(axis=0)
+            total_sq += (block * block).sum(axis=0)
+        n = max(n_spectra, 1)
+        self.mean = total / n
+        if normalize:
+            std = np.sqrt(np.maximum(total_sq / n - self.mean ** 2, 0))
+            std[std == 0] = 1.0
+            self.scale = std
+        else:
+            self.scale = np.ones(n_bands)
+
+        self.transform = None
+        if n_components is not None:
+            cov = np.zeros((n_bands, n_bands))
+            for i in range(0, n_spectra, self.block_size):
+                block = (np.asarray(spectra[i:i + self.block_size],
+                                    dtype=np.float64) - self.mean) / self.scale
+                cov += block.T.dot(block)
+            (vals, vecs) = np.linalg.eigh(cov / n)
+            order = np.argsort(vals)[::-1][:int(n_components)]
+            self.transform = vecs[:, order]
+
+        # The indexed forms of the library spectra for each distance.
+        self.features = np.vstack(
+            [self._features(spectra[i:i + self.block_size])
+             for i in range(0, n_spectra, self.block_size)] or
+            [np.zeros((0, self._n_features()), dtype=np.float32)])
+        self.units = np.vstack(
+            [_unit_spectra(spectra[i:i + self.block_size])
+             for i in range(0, n_spectra, self.block_size)] or
+            [np.zeros((0, n_bands), dtype=np.float32)])
+        self._features_sq = (self.features.astype(np.float64) ** 2).sum(axis=1)
+        self._trees = {}
+
+    def _n_features(self):
+        if self.transform is None:
+            return self.n_bands
+        return self.transform.shape[1]
+
+    def _features(self, spectra):
+        '''Returns the Euclidean-distance features of `spectra` as float32.'''
+        x = (np.asarray(spectra, dtype=np.float64) - self.mean) / self.scale
+        if self.transform is not None:
+            x = x.dot(self.transform)
+        return x.astype(np.float32)
+
+    def query(self, spectra, k=1, metric='euclidean'):
+        '''
+        Finds the `k` library spectra nearest to each of `spectra`.
+
+        Arguments:
+
+            `spectra` (array-like):
+
+                A single spectrum of length `B`, or an `NxB` array of spectra,
+                where `B` is the number of bands in the library.
+
+            `k` (int, default 1):
+
+                Number of nearest library spectra to return for each spectrum.
+
+            `metric` (str, default 'euclidean'):
+
+                Either 'euclidean' or 'angle' (see :class:`SpectralLibraryIndex`).
+
+        Returns:
+
+            (`distances`, `indices`):
+
+                Two `Nxk` arrays (length-`k` arrays for a single spectrum)
+                giving, nearest first, the distances to and the indices into
+                the library of the nearest spectra. Angles are in radians.
+        '''
+        if metric not in ('euclidean', 'angle'):
+            raise ValueError('Unknown metric: %s' % str(metric))
+        spectra = np.asarray(spectra)
+        single = (spectra.ndim == 1)
+        spectra = np.atleast_2d(spectra)
+        if spectra.shape[1] != self.n_bands:
+            raise ValueError('Number of bands in query spectra does not '
+                             'match library')
+        k = min(int(k), self.features.shape[0])
+        if k < 1:
+            raise ValueError('Library is empty or k is less than 1')
+
+        if metric == 'euclidean':
+            points = self._features(spectra)
+            library = self.features
+        else:
+            points = _unit_spectra(spectra)
+            library = self.units
+
+        if self.kdtree:
+            (distances, indices) = self._query_tree(metric, library, points, k)
+        else:
+            (distances, indices) = self._query_blocks(metric, library, points, k)
+
+        if single:
+            return (distances[0], indices[0])
+        return (distances, indices)
+
+    def _query_tree(self, metric, library, points, k):
+        if metric not in self._trees:
+            from scipy.spatial import cKDTree
+            self._trees[metric] = cKDTree(library)
+        (distances, indices) = self._trees[metric].query(points, k=k)
+        distances = np.asarray(distances).reshape(len(points), k)
+        indices = np.asarray(indices).reshape(len(points), k)
+        if metric == 'angle':
+            # Chord length between unit vectors to angle between them.
+            distances = 2 * np.arcsin(np.clip(distances / 2, 0, 1))
+        return (distances, indices)
+
+    def _query_blocks(self, metric, library, points, k):
+        n_points = points.shape[0]
+        n_library = library.shape[0]
+        points = points.astype(np.float64)
+        # Size query blocks so each block of scores has about as many
+        # entries as block_size rows of the library have values.
+        query_block = max(1, (self.block_size * library.shape[1]) //
+                          max(min(self.block_size, n_library), 1))
+        best_scores = np.empty((n_points, k))
+        best_indices = np.empty((n_points, k), dtype=np.intp)
+
+        for q in range(0, n_points, query_block):
+            query = points[q:q + query_block]
+            if metric == 'euclidean':
+                query_sq = (query ** 2).sum(axis=1)[:, np.newaxis]
+            scores = None
+            indices = None
+            for i in range(0, n_library, self.block_size):
+                block = library[i:i + self.block_size].astype(np.float64)
+                # Smaller scores are nearer: squared distance or -cos.
+                if metric == 'euclidean':
+                    s = query_sq + self._features_sq[i:i + len(block)] \
+                        - 2 * query.dot(block.T)
+                else:
+                    s = -query.dot(block.T)
+                ind = np.broadcast_to(np.arange(i, i + len(block)), s.shape)
+                if scores is not None:
+                    s = np.hstack((scores, s))
+                    ind = np.hstack((indices, ind))
+                if s.shape[1] > k:
+                    part = np.argpartition(s, k - 1, axis=1)[:, :k]
+                    s = np.take_along_axis(s, part, axis=1)
+                    ind = np.take_along_axis(ind, part, axis=1)
+                (scores, indices) = (s, ind)
+            order = np.argsort(scores, axis=1, kind='stable')
+            best_scores[q:q + len(query)] = np.take_along_axis(scores, order, axis=1)
+            best_indices[q:q + len(query)] = np.take_along_axis(indices, order, axis=1)
+
+        if metric == 'euclidean':
+            distances = np.sqrt(np.maximum(best_scores, 0))
+        else:
+            distances = np.arccos(np.clip(-best_scores, -1, 1))
+        return (distances, best_indices)
+
+def _unit_spectra(spectra):
+    '''Returns `spectra` scaled to unit length (zero spectra are left zero).'''
+    x = np.asarray(spectra, dtype=np.float64)
+    norms = np.sqrt((x * x).sum(axis=-1))
+    norms = np.where(norms == 0, 1.0, norms)
+    return (x / norms[..., np.newaxis]).astype(np.float32)
+
 def _write_header_param(fout, paramName, paramVal):
     if paramName.lower() == 'description':
         valStr = '{\n%s}' % '\n'.join(['  ' + line for line
@@ -27,6 +27,7 @@ def displayHelp():
     print("1) python picker.py -h or python picker.py --Help, which displays this message; or")
     print("2) python picker.py -i <infile>, or python plotter.py --Input <infile> which displayes the image in <infile> to allow the selection of point spectra; with the option of")
     print("3) python picker.py -o <outfile> or  plotter.py --Output <outfile> in which case the CSV output is written into <outfile> rather than a default.")
+    print("Adding -g or --Gain applies the gain values in the header to the image data, so there is no need to run convert.py first.")
     print("<infile> should be a hyperspectral .hdr file and <outfile> will be a CSV so a .csv extension would be appropriate.")
 #
 # Just reads commandline arguments. All the work is done by functions
@@ -37,16 +38,17 @@ def main():
     help = False
     inputFile = False
     outputFile = False
+    gain = False
 
     # Drop the filename from the list of command line arguments
     argList = sys.argv[1:]
 
     # We support help, printing all spectra, or computing and printing
     # the pointwise average of the spectra
-    options = "hi:o:"
+    options = "hgi:o:"
 
     # Long options
-    long_options = ["Help", "Input=", "Output="]
+    long_options = ["Help", "Gain", "Input=", "Output="]
 
     try:
         # Parsing argument
@@ -70,13 +72,17 @@ def main():
             elif currentArgument in ("-o", "--Output"):
                 outputFile = True
                 outName = currentValue
+
+            # Apply the gain as the data is read
+            elif currentArgument in ("-g", "--Gain"):
+                gain = True
                     
         # Now process the image so long as we have at least specified
         # an input file. If we have specified help, then we do no
         # processing.
         if (not help) and inputFile:
 
-            bands, intensities = utils.selectPoints(fileName)
+            bands, intensities = utils.selectPoints(fileName, gain)
             
             if outputFile:
                 utils.outputCSVFile(bands, intensities, outName)
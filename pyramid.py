@@ -0,0 +1,93 @@
+# pyramid.py
+#
+# A script to build the pyramid of smaller copies of an image that
+# viewer.py -p uses, so that a big image can be shown straight away
+# the first time it is viewed.
+#
+# Simon Parsons
+# October 2026
+#
+# Borrowing from:
+# https://www.spectralpython.net
+# https://www.geeksforgeeks.org/command-line-arguments-in-python/
+
+# The pyramid is kept in a directory <filename>-pyramid next to the
+# header file.
+
+import sys
+import getopt
+import spectral as sp
+import utils
+
+#
+# Print help message.
+#
+def displayHelp():
+    print("pyramid.py expects to be run in the following modes:")
+    print("1) python pyramid.py -h or python pyramid.py --Help, which displays this message.")
+    print("2) python pyramid.py -i <filename>, or python pyramid.py --Input <filename> which builds the pyramid for the bands that viewer.py -d shows.")
+    print("3) Using -b \"band1 band2 band3\" or --Bands \"band1 band2 band3\" builds the pyramid for the given bands, as shown by viewer.py -b.")
+    print("4) Using -g or --Gain builds the pyramid from the gain adjusted image (for viewer.py -g).")
+    print("5) Using -f or --Force rebuilds the pyramid even if it is up to date.")
+    print("<filename> should be a hyperspectral image header file. The pyramid is written to the directory <filename>-pyramid.")
+
+
+def main():
+    # Set flags
+    help = False
+    inputFile = False
+    gotBands = False
+    gain = False
+    force = False
+    # Drop the filename from the list of command line arguments
+    argList = sys.argv[1:]
+
+    # We support help, input, bands, gain and force. Input and bands
+    # have associated values.
+    options = "hi:b:gf"
+
+    # Long options.
+    long_options = ["Help", "Input=", "Bands=", "Gain", "Force"]
+
+    try:
+        # Parsing argument
+        arguments, values = getopt.getopt(argList, options, long_options)
+
+        for currentArgument, currentValue in arguments:
+            if currentArgument in ("-h", "--Help"):
+                help = True
+                displayHelp()
+
+            elif currentArgument in ("-i", "--Input"):
+                inputFile = True
+                fileName = currentValue
+
+            elif currentArgument in ("-b", "--Bands"):
+                gotBands = True
+                bands = list(map(int, currentValue.split()))
+
+            elif currentArgument in ("-g", "--Gain"):
+                gain = True
+
+            elif currentArgument in ("-f", "--Force"):
+                force = True
+
+        if (not help) and inputFile:
+            if not gotBands:
+                bands = utils.defaultRGBBands(utils.getImage(fileName))
+            levels = utils.buildPyramid(fileName, bands, gain, force=force)
+            for factor, name in levels:
+                print(str(factor) + "x: " + name)
+            if not levels:
+                print("The image is small enough not to need a pyramid")
+
+        elif not help:
+            print("Need to specify an input file")
+            displayHelp()
+
+    except getopt.error as err:
+        # output error, and return with an error code
+        print (str(err))
+
+if __name__ == "__main__":
+    main()
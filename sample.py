@@ -11,9 +11,13 @@
 # https://www.geeksforgeeks.org/python-integers-string-to-integer-list/
 
 # Note that this just prints the sample points --- you will need to
-# redirect to a file if you want to capture it.
+# redirect to a file if you want to capture it. For more than a few
+# points, read them from a file with -r and write the samples to a file
+# with -o.
 
 import sys
+import os
+import glob
 import getopt
 import spectral as sp
 import utils
@@ -26,9 +30,16 @@ def displayHelp():
     print("1) python sample.py -h, which displays this message.")
     print("2) python sample.py -p <list of coordinate> -f  <filename>, which prints the data from  <filename> at the coordinates.")
     print("3)  python sample.py -p <list of coordinate> -f  <filename> -b <bands>, which prints the data from  <filename> at the coordinates and for the specific bands in <bands>.")
+    print("4) python sample.py -r <points file> -f <filename> -o <output file>, or python sample.py --Read <points file> --File <filename> --Output <output file>, which samples <filename> at every point in <points file> and writes the samples to <output file> as it goes, printing progress. -b can be added as in 3).")
+    print("5) python sample.py -r <points file> -f <directory> -o <output file>, or python sample.py -r <points file> -f \"<pattern>\" -o <output file>, samples every file matching a pattern like \"raw-data-*/*.hdr\" or \"raw-data-*/*-gain-adjusted.hdr\", or every .hdr file in <directory> other than those made from another image there (such as <filename>-gain-adjusted or <filename>-calibrated), at every point in <points file>. -n <n> or --Workers <n> samples <n> files at a time. The <output file> has one line for each file, point and band, giving the file, the number of the point, the band and the value, or if its name ends in .npy holds an array of files x points x bands. A summary of the time taken for each file is printed at the end.")
+    print("Adding -g or --Gain applies the gain values in the header to the samples, so there is no need to run convert.py first.")
     print("In all cases <filename> should be a hyperspectral image header file.")
     print("The <list of ccordinates> are a string \"x1 y1 x2 y2 ...\" for ease of parsing from the command line.")
     print("The set of <bands> are similarly a string with the indices of the bands required.")
+    print("A <points file> is a CSV file with a row and a column on each line, or a .npy file holding an array of [row, column] pairs.")
+    print("The <output file> has the same layout as the .csv files from picker.py: the bands on the first line, then the samples at each point. If its name ends in .npy, the same thing is written as a float32 numpy array.")
+    print("Adding -o <output file> to 2) or 3) writes the samples to <output file> rather than printing them.")
+    print("Adding -w <size> or --Window <size> to any of 2) to 5) gives the mean over a <size> x <size> square of pixels around each point rather than the single pixel.")
 
 def main():
     # Set flags
@@ -36,15 +47,21 @@ def main():
     gotPoints = False
     gotBands = False
     inputFile = False
+    gain = False
+    pointsFile = False
+    outputFile = False
+    window = None
+    workers = 1
 # Drop the filename from the list of command line arguments
     argList = sys.argv[1:]
 
     # We support help, points and bands and file. Convert and output have
     # associated values.
-    options = "hp:b:f:"
+    options = "hgp:b:f:r:o:w:n:"
 
     # Long options. Again Convert and Output take values.
-    long_options = ["Help", "Points=", "Bands=", "File="]
+    long_options = ["Help", "Gain", "Points=", "Bands=", "File=", "Read=", "Output=",
+                    "Window=", "Workers="]
 
     try:
         # Parsing argument
@@ -76,19 +93,66 @@ def main():
                 gotBands = True
                 bands = list(map(int, currentValue.split()))
 
+            elif currentArgument in ("-g", "--Gain"):
+                gain = True
+
+            # A file of points to sample at
+            elif currentArgument in ("-r", "--Read"):
+                pointsFile = True
+                pointsName = currentValue
+
+            # Where to write the samples
+            elif currentArgument in ("-o", "--Output"):
+                outputFile = True
+                outName = currentValue
+
+            # Average over a square of pixels around each point
+            elif currentArgument in ("-w", "--Window"):
+                window = int(currentValue)
+
+            # Number of files to sample at once
+            elif currentArgument in ("-n", "--Workers"):
+                workers = int(currentValue)
+
         # Now process the image so long as we have at least specified
         # a pair of point coordinates and a file. If we have specified
         # help, then we do no processing.
         #
         # Note that there is no error checking here on the format of
         # the points and bands data.
-        if (not help) and gotPoints and inputFile:
-            if gotBands:
-                output = utils.sampleImageAtBands(points, bands, fileName)
+        if (not help) and pointsFile and inputFile:
+            if not outputFile:
+                outName = 'samples.csv'
+            if not gotBands:
+                bands = None
+            if os.path.isdir(fileName) or glob.has_magic(fileName):
+                # A whole series of files, sampled a file at a time by
+                # each of the workers.
+                files = utils.findSeriesFiles(fileName)
+                if files:
+                    results = utils.sampleSeries(pointsName, files, outName, bands, gain,
+                                                 window, workers)
+                    utils.printSeriesSummary(results)
+                else:
+                    print("No header files match " + fileName)
+            else:
+                utils.streamSamples(pointsName, fileName, outName, bands, gain, window=window)
+
+        elif (not help) and gotPoints and inputFile:
+            if window:
+                output = utils.sampleImageWindows(points, window, fileName,
+                                                  bands if gotBands else None, gain)
+            elif gotBands:
+                output = utils.sampleImageAtBands(points, bands, fileName, gain)
             else:
-                output = utils.sampleImage(points, fileName)
+                output = utils.sampleImage(points, fileName, gain)
 
-            print(output)
+            if outputFile:
+                image = utils.getImage(fileName, gain)
+                labels = utils.sampleBandLabels(image, bands if gotBands else None)
+                utils.outputCSVFile(labels, output.tolist(), outName)
+            else:
+                print(output.tolist())
 
     except getopt.error as err:
         # output error, and return with an error code
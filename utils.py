@@ -13,9 +13,20 @@
 # https://medium.com/@achyutpaudel50/hyperspectral-image-processing-in-python-custom-roi-selection-with-mouse-78fbaf7520aa
 
 import spectral as sp
+from spectral.image import Image, ImageArray
+from spectral.graphics.graphics import get_rgb_meta
 import numpy as np
 import cv2
 import csv
+import os
+import glob
+import time
+import shutil
+import hashlib
+import multiprocessing
+import mmap
+import json
+import atexit
 import matplotlib.pyplot as plt
 
 # Functions are grouped somewhat thematically until I can come up with
@@ -104,10 +115,17 @@ def locateBandsinImage(bands, wavelength):
 
 # Extract the specified wavebands from a file. The expected use of
 # this is to to create an RGB image, hence the name.
-def showRGBImage(file, bands):
-    # load image from file and grab the relevant wavelengths
-    image = getImage(file)
-    rgbImage = sp.get_rgb(image, bands=(int(bands[0]), int(bands[1]), int(bands[2])))
+#
+# If gain is True, the gain is applied to the image data (see getImage).
+# If cache is True, the RGB image is kept in the cache (see cachedRGB).
+def showRGBImage(file, bands, gain=False, cache=False):
+    bands = (int(bands[0]), int(bands[1]), int(bands[2]))
+    if cache:
+        rgbImage = cachedRGB(file, bands, gain)
+    else:
+        # load image from file and grab the relevant wavelengths
+        image = getImage(file, gain)
+        rgbImage = sp.get_rgb(image, bands=bands)
     # Use OpenCV to display the image. Click on the window when done.
     cv2.namedWindow("main", cv2.WINDOW_NORMAL)
     cv2.imshow('main', rgbImage)
@@ -116,10 +134,13 @@ def showRGBImage(file, bands):
 
 # As above, but makes use of get_rgb's ability to infer (or at least
 # guess) the rigt wavebands.
-def showDefaultRGBImage(file):
-    # load image from file and grab the relevant wavelengths
-    image = getImage(file)
-    rgbImage = sp.get_rgb(image)
+def showDefaultRGBImage(file, gain=False, cache=False):
+    if cache:
+        rgbImage = cachedRGB(file, None, gain)
+    else:
+        # load image from file and grab the relevant wavelengths
+        image = getImage(file, gain)
+        rgbImage = sp.get_rgb(image)
     # Use OpenCV to display the image. Click on the window when done.
     cv2.namedWindow("main", cv2.WINDOW_NORMAL)
     cv2.imshow('main', rgbImage)
@@ -132,21 +153,125 @@ def showDefaultRGBImage(file):
 
 # Use the spectral package to create a file object (data isn't loaded
 # until it is accessed.
-def getImage(file):
-    return sp.open_image(file)
+#
+# If gain is True, the image that is returned applies the gain from
+# the header (the "data gain values") to the data as it is read. See
+# GainAdjustedImage below. This gives the same values as running
+# convert.py and then opening the converted image, without having to
+# write the converted image to disk. Like convert.py, this requires
+# the hacked version of envi.py
+#
+# If $HYPER_READ_STATS is set, the image also counts what is read from
+# it (see InstrumentedImage).
+def getImage(file, gain=False):
+    image = sp.open_image(file)
+    if readStatsSetting:
+        image = InstrumentedImage(image)
+    if gain:
+        return GainAdjustedImage(image)
+    return image
+
+# A "virtual" gain adjusted image. This wraps a SpyFile and offers the
+# same ways of reading data (indexing, read_band, read_bands,
+# read_pixel, read_subregion, read_subimage, read_datum and load), but
+# multiplies whatever is read by the gain for each band. Nothing is
+# read until it is asked for, just as with the SpyFile, so this works
+# on images of any size. Since it is a spectral Image, the spectral
+# package functions (get_rgb, principal_components and so on) accept
+# it just like a SpyFile.
+#
+# Values come back as float, and are exactly those that
+# gainAdjustImage computes.
+class GainAdjustedImage(Image):
+
+    def __init__(self, image, gain=None):
+        params = image.params()
+        self.set_params(params, params.metadata)
+        self.image = image
+        if gain is None:
+            gain = image.bands.bandwidths
+        self.gain = np.asarray(gain, dtype='float')
+        if self.gain.shape != (image.shape[2],):
+            raise ValueError('Number of gain values does not match the number of bands')
+        self.shape = image.shape
+        self.dtype = np.dtype('float').char
+        self.filename = image.filename
+        self.interleave = image.interleave
+        # The size of each value as it is stored in the file, which is
+        # what planRead needs.
+        self.sample_size = image.sample_size
+
+    @property
+    def bands(self):
+        return self.image.bands
+
+    # Multiply data by the gain. bands picks out the gain values that
+    # go with the last axis of data, and can be anything that will
+    # index a numpy array (an int, a slice, or a list or tuple of band
+    # indices); None means all the bands.
+    def adjust(self, data, bands=None):
+        if bands is None:
+            gain = self.gain
+        elif isinstance(bands, tuple):
+            gain = self.gain[list(bands)]
+        else:
+            gain = self.gain[bands]
+        return np.multiply(data, gain, dtype='float')
+
+    def __getitem__(self, args):
+        data = self.image[args]
+        if len(args) < 3:
+            return self.adjust(data)
+        return self.adjust(data, args[2])
+
+    def __str__(self):
+        s = '\tGainAdjustedImage, applying the data gain values to:\n\n'
+        s += str(self.image)
+        return s
+
+    def read_band(self, band):
+        return self.adjust(self.image.read_band(band), band)
+
+    def read_bands(self, bands):
+        return self.adjust(self.image.read_bands(bands), bands)
+
+    def read_pixel(self, row, col):
+        return self.adjust(self.image.read_pixel(row, col))
+
+    # See readPixels.
+    def read_pixels(self, pixels, bands=None):
+        data = self.adjust(readPixels(self.image, pixels, bands), bands)
+        return data.astype(np.float32)
+
+    def read_datum(self, i, j, k):
+        return self.adjust(self.image.read_datum(i, j, k), k)
+
+    def read_subregion(self, row_bounds, col_bounds, bands=None):
+        data = self.image.read_subregion(row_bounds, col_bounds, bands)
+        return self.adjust(data, bands)
+
+    def read_subimage(self, rows, cols, bands=None):
+        data = self.image.read_subimage(rows, cols, bands)
+        return self.adjust(data, bands)
+
+    # Read the whole image. As with SpyFile.load this returns an
+    # ImageArray, but holding float values.
+    def load(self):
+        data = self.image.load(dtype='float')
+        return ImageArray(self.adjust(np.asarray(data)), self)
 
 # Use the spectral package to create a new data and header file for
 # the data in the image. It will use the given name.
 #
-# Note that for now this only uses the default (.img) extension for
-# the data file.
+# The keywords ext (the extension of the data file, .img by default),
+# metadata (extra header values) and force (overwrite existing files)
+# are passed on to the spectral package; anything else is ignored.
 def outputFile(name, image, **kwargs):
-    if kwargs:
-        for k, val in kwargs.items():
-            if k == 'ext':
-                sp.envi.save_image(name, image, ext=val, dtype=np.float32)
-    else:
-        sp.envi.save_image(name, image, dtype=np.float32)
+    saveArgs = {}
+    for k, val in kwargs.items():
+        if k in ('ext', 'metadata', 'force'):
+            saveArgs[k] = val
+    sp.envi.save_image(name, image, dtype=np.float32, **saveArgs)
 
 # Open a CSV file of waveforms and extract the set of bands and intensities
 def openWavebandFile(file):
@@ -180,21 +305,61 @@ def outputCSVFile(bands, intensities, file):
 # Gain adjustment
 #
 
+# Number of image rows that the gain adjustment works on at a time. A
+# block of rows is read from the file in one go and the gain for each
+# band is applied to the whole block with a single numpy multiply,
+# which is much faster than visiting every pixel in turn. Bigger blocks
+# use more memory; 64 rows of a 1024 x 224 band image is about 115MB of
+# floats.
+gainBlockRows = 64
+
+# The types that gain adjusted images can be written as. float32 is
+# what we have always used. uint16 halves the size of the file by
+# storing each value v as the integer round(v * scale), and recording
+# scale in the header as the "reflectance scale factor". The spectral
+# package divides this back out when the image is read, so the rest of
+# the code sees the same values, to within 1/scale. ENVI has no 16 bit
+# float type, so float16 is not an option.
+gainOutputTypes = ['float32', 'uint16']
+
+# The header value in which a gain adjusted image records the gain that
+# was applied to it. This lets us tell whether an existing converted
+# image still matches its source. (We can't reuse "data gain values"
+# since then the gain would look like it still needed applying.)
+gainRecordKey = 'gain adjustment values'
+
+# The header values in which a gain adjusted image records the type it
+# was written as and, for uint16, the scale that was asked for ("auto"
+# if gainScaleFactor picked it), so that a conversion with a different
+# -t or -s isn't taken to be up to date.
+gainTypeKey = 'gain adjustment type'
+gainScaleKey = 'gain adjustment scale'
+
 # Perform gain adjustment on the file. Just load the relevant image,
 # extract the gain data and pass to gainAdjustImage.
 #
 # Note that extracting the gain requires the hacked version of envi.py
-def gainAdjustFile(file):
+def gainAdjustFile(file, blockRows=gainBlockRows, dtype='float'):
     # load image data and extract the 
     image = getImage(file)
     gain = image.bands.bandwidths
-    adjustedImage = gainAdjustImage(image, gain)
+    adjustedImage = gainAdjustImage(image, gain, blockRows, dtype)
 
     return adjustedImage
 
 # Perform gain adjustment on an image. Assumes we have the gain data
 # already extracted.
-def gainAdjustImage(image, gain):
+#
+# Re-written (October 2026) to work on blocks of blockRows rows at a
+# time rather than pixel by pixel. The result is identical to the
+# original version, which multiplied each value (as a float) by the
+# gain for its band.
+#
+# dtype is the type of the array that is returned. Each block is still
+# worked out as float before being stored, so asking for float32 gives
+# exactly what saving the float version as float32 would, while only
+# needing half the memory.
+def gainAdjustImage(image, gain, blockRows=gainBlockRows, dtype='float'):
     # image is a "cube" of rows x columns x bands. gain is a
     # adjustment per band. We adjust for the gain across the entire
     # image.
@@ -202,11 +367,1528 @@ def gainAdjustImage(image, gain):
     columns = image.shape[1]
     bands = image.shape[2]
 
-    newImage = np.empty(shape=(rows, columns, bands), dtype='float')
-    for i in range(bands):
-        for j in range(rows):
-                for k in range(columns):
-                    newImage[j,k,i] = image[j,k,i] * gain[i]
+    gainVector = np.asarray(gain, dtype='float')
+    newImage = np.empty(shape=(rows, columns, bands), dtype=dtype)
+    for start, stop in rowBlocks(rows, blockRows):
+        block = readRowBlock(image, start, stop)
+        newImage[start:stop] = gainAdjustBlock(block, gainVector)
+    return newImage
+
+# Apply the gain to a block of rows x columns x bands data. The gain
+# vector broadcasts across the last (band) axis.
+def gainAdjustBlock(block, gainVector, dtype='float'):
+    return np.multiply(block, gainVector, dtype=dtype)
+
+# Apply the gain to a block, as above, and then convert the result to
+# scaled integers for a uint16 image. The arithmetic is done in float32
+# to keep the size of the intermediate block down.
+def gainAdjustScaledBlock(block, gainVector, scale):
+    adjusted = gainAdjustBlock(block, gainVector, np.float32)
+    adjusted *= np.float32(scale)
+    np.rint(adjusted, out=adjusted)
+    np.clip(adjusted, 0, np.iinfo(np.uint16).max, out=adjusted)
+    return adjusted.astype(np.uint16)
+
+# Work out the scale factor for writing the gain adjusted version of
+# image as uint16, so that the largest adjusted value maps to the
+# largest uint16. This takes a pass over the image, blockRows rows at a
+# time.
+def gainScaleFactor(image, gainVector, blockRows=gainBlockRows):
+    largest = 0
+    for start, stop in rowBlocks(image.shape[0], blockRows):
+        block = readRowBlock(image, start, stop)
+        largest = max(largest, float(np.max(gainAdjustBlock(block, gainVector, np.float32))))
+    if largest <= 0:
+        return 1.0
+    return np.iinfo(np.uint16).max / largest
+
+# Split rows into consecutive (start, stop) ranges of at most
+# blockRows rows.
+def rowBlocks(rows, blockRows):
+    blockRows = max(1, int(blockRows))
+    return [(start, min(start + blockRows, rows))
+            for start in range(0, rows, blockRows)]
+
+# Read rows start to stop-1 of an image as a rows x columns x bands
+# array. For a SpyFile this goes through read_subregion, which uses the
+# file's memmap where there is one, and applies any reflectance scale
+# factor just as indexing the image does.
+#
+# Values from a file in the other byte order (see nativeOrderFile) are
+# put into native order here, one block at a time, rather than every
+# numpy operation on the block having to convert them again.
+def readRowBlock(image, start, stop):
+    if isinstance(image, np.ndarray):
+        return nativeOrder(np.asarray(image[start:stop]))
+    return nativeOrder(image.read_subregion((start, stop), (0, image.shape[1])))
+
+# Return data with its values in native byte order, converting them if
+# need be.
+def nativeOrder(data):
+    if data.dtype.isnative:
+        return data
+    return data.astype(data.dtype.newbyteorder('='))
+
+# Perform gain adjustment on the file, writing the result straight into
+# a new image file called name rather than building the whole adjusted
+# image in memory. The data file is created first and opened as a
+# memmap (see createParallelImage), and then each block of blockRows
+# rows is read, adjusted and written into that memmap in turn. Memory
+# use therefore depends on the block size, not on the size of the
+# image. The header is only written once all the data is there, so if
+# the conversion fails partway there is no header, and the output
+# isn't mistaken for an up to date one (see isGainAdjustedUpToDate).
+#
+# By default the output is the same as that written by gainAdjustFile
+# followed by outputFile: float32 values in a bip file. outputType can
+# be any of gainOutputTypes; for uint16, scale is the scale factor to
+# use, and if it is not given gainScaleFactor works one out. As with
+# outputFile the keywords we handle are ext, the extension of the
+# image file, and force.
+def streamGainAdjustFile(file, name, blockRows=gainBlockRows, outputType='float32', scale=None, **kwargs):
+    image = getImage(file)
+    gainVector = np.asarray(image.bands.bandwidths, dtype='float')
+    autoScale = (scale is None)
+    if outputType == 'uint16' and scale is None:
+        scale = gainScaleFactor(image, gainVector, blockRows)
+
+    metadata = gainAdjustedMetadata(image, outputType, scale, autoScale)
+    output = createParallelImage(name, metadata, image.shape, outputType, 'bip', **kwargs)
+    newData = openParallelRows(output, 0, image.shape[0])
+    gainAdjustRows(image, gainVector, newData, 0, image.shape[0], blockRows, scale)
+    newData.flush()
+    del newData
+
+    return finishParallelImage(output)
+
+# As streamGainAdjustFile, but the rows of the image are split into
+# (at most) one range per worker, and a pool of worker processes
+# converts the ranges in parallel, all writing into the one new image
+# (see createParallelImage). The header is only written once every
+# worker has finished.
+def parallelGainAdjustFile(file, name, workers, blockRows=gainBlockRows, outputType='float32', scale=None, **kwargs):
+    image = getImage(file)
+    rows = image.shape[0]
+    autoScale = (scale is None)
+    if outputType == 'uint16' and scale is None:
+        gainVector = np.asarray(image.bands.bandwidths, dtype='float')
+        scale = gainScaleFactor(image, gainVector, blockRows)
+
+    metadata = gainAdjustedMetadata(image, outputType, scale, autoScale)
+    output = createParallelImage(name, metadata, image.shape, outputType, 'bip', **kwargs)
+    jobs = []
+    for start, stop in rowBlocks(rows, -(-rows // workers)):
+        jobs.append((file, output, start, stop, blockRows, scale))
+
+    with multiprocessing.Pool(workers) as pool:
+        pool.starmap(gainAdjustRowRange, jobs)
+
+    return finishParallelImage(output)
+
+# The job run by each of the workers in parallelGainAdjustFile: gain
+# adjust rows start to stop-1 of file into the same rows of output.
+def gainAdjustRowRange(file, output, start, stop, blockRows, scale=None):
+    image = getImage(file)
+    gainVector = np.asarray(image.bands.bandwidths, dtype='float')
+    newData = openParallelRows(output, start, stop)
+    gainAdjustRows(image, gainVector, newData, start, stop, blockRows, scale, start)
+    newData.flush()
+    del newData
+
+# Gain adjust rows start to stop-1 of image, blockRows rows at a time,
+# writing the results into the matching rows of newData, which holds
+# the rows of the new image from row first on. If scale is given,
+# newData is a uint16 image and the results are scaled to fit.
+def gainAdjustRows(image, gainVector, newData, start, stop, blockRows, scale=None, first=0):
+    for blockStart, blockStop in rowBlocks(stop - start, blockRows):
+        blockStart += start
+        blockStop += start
+        block = readRowBlock(image, blockStart, blockStop)
+        if scale is None:
+            newData[blockStart - first:blockStop - first] = gainAdjustBlock(block, gainVector)
+        else:
+            newData[blockStart - first:blockStop - first] = gainAdjustScaledBlock(block, gainVector, scale)
+
+# The header values for a gain adjusted version of image, holding
+# outputType values: the gain, and for uint16 images the scale factor.
+# autoScale says whether scale was picked by gainScaleFactor rather
+# than asked for.
+def gainAdjustedMetadata(image, outputType='float32', scale=None, autoScale=False):
+    if outputType not in gainOutputTypes:
+        raise ValueError('Invalid output type: %s' % str(outputType))
+    metadata = gainMetadata(image.bands.bandwidths, outputType, None if autoScale else scale)
+    if outputType == 'uint16':
+        metadata['reflectance scale factor'] = scale
+    return metadata
+
+# The header values that record how a gain adjusted image was made: the
+# gain applied, the type it was written as, and for uint16 the scale
+# that was asked for (None if it was left to gainScaleFactor).
+def gainMetadata(gain, outputType='float32', scale=None):
+    metadata = {gainRecordKey: [float(g) for g in gain], gainTypeKey: outputType}
+    if outputType == 'uint16':
+        metadata[gainScaleKey] = 'auto' if scale is None else float(scale)
+    return metadata
+
+# Print how long it took to process an image, and how much image data
+# was processed per second. size is in bytes and start is the time,
+# from time.time(), at which the processing started.
+def reportThroughput(size, start):
+    elapsed = max(time.time() - start, 1e-9)
+    megabytes = size / 1024**2
+    print("Processed %.1f MB in %.2f s (%.1f MB/s)" % (megabytes, elapsed, megabytes / elapsed))
+
+# The size, in bytes, of the data in an image.
+def imageBytes(image):
+    return int(np.prod(image.shape)) * np.dtype(image.dtype).itemsize
+
+# Convert a memory size given as a string, such as "512M" or "2G", into
+# a number of bytes. A plain number is taken to be bytes.
+def parseMemorySize(size):
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size = str(size).strip().upper()
+    if size.endswith('B'):
+        size = size[:-1]
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size))
+
+# Work out how many rows of image can be gain adjusted at a time while
+# keeping within maxMemory bytes. For each row we hold the raw data
+# that was read, a float (64 bit) copy if there is a scale factor to
+# apply, and the float result of applying the gain. We always allow at
+# least one row.
+def blockRowsForMemory(image, maxMemory):
+    columns = image.shape[1]
+    bands = image.shape[2]
+    bytesPerValue = np.dtype(image.dtype).itemsize + 8 + 8
+    rowBytes = columns * bands * bytesPerValue
+    return max(1, min(image.shape[0], int(maxMemory) // rowBytes))
+
+#
+# Writing one image from several processes
+#
+
+# envi.create_image gives us a memmap of a new image, but writes the
+# header straight away, so a crash part way through leaves what looks
+# like a finished image. For images written by a pool of workers we
+# instead:
+#
+#  1) create the data file at its full size, without writing anything
+#     to it (so on most file systems it takes no space until it is
+#     written), and no header (createParallelImage);
+#  2) have each worker open its own memmap of the rows it is to write
+#     (openParallelRows). The workers' rows don't overlap, so there is
+#     no need for any locking;
+#  3) write the header once all the workers have finished, to a
+#     temporary file that is then renamed, so the header either
+#     describes complete data or isn't there (finishParallelImage).
+#
+# What is passed between these is a dictionary describing the new
+# image, which is small and easily sent to the workers.
+
+# Create the data file for an image with header name, holding values
+# of type dtype (in native byte order) in an array of the given shape
+# (rows, columns, bands) stored with the given interleave. metadata
+# gives any other header values. As with outputFile the keywords we
+# handle are ext, the extension of the image file, and force.
+def createParallelImage(name, metadata, shape, dtype, interleave='bip', **kwargs):
+    interleave = interleave.lower()
+    if interleave not in ['bil', 'bip', 'bsq']:
+        raise ValueError('Invalid interleave: %s' % str(interleave))
+    dtype = np.dtype(dtype).newbyteorder('=')
+    (headerFile, dataFile) = sp.envi.check_new_filename(name, kwargs.get('ext', '.img'),
+                                                        kwargs.get('force', False))
+    # Any old header goes first, so that it can't describe the data
+    # while it is only partly written.
+    if os.path.exists(headerFile):
+        os.remove(headerFile)
+    with open(dataFile, 'wb') as f:
+        f.truncate(int(np.prod(shape)) * dtype.itemsize)
+
+    metadata = dict(metadata)
+    metadata['lines'] = shape[0]
+    metadata['samples'] = shape[1]
+    metadata['bands'] = shape[2]
+    metadata['header offset'] = 0
+    metadata['data type'] = sp.envi.dtype_to_envi[dtype.char]
+    metadata['interleave'] = interleave
+    metadata['byte order'] = sp.byte_order
+    return {'header': headerFile, 'data': dataFile, 'shape': tuple(shape),
+            'dtype': dtype.str, 'interleave': interleave, 'metadata': metadata}
+
+# Open rows start to stop-1 of the image described by output (from
+# createParallelImage) for writing, as a rows x columns x bands memmap,
+# whatever the interleave. Call flush on the result when done.
+def openParallelRows(output, start, stop):
+    (rows, cols, bands) = output['shape']
+    if output['interleave'] == 'bip':
+        data = np.memmap(output['data'], dtype=output['dtype'], mode='r+', shape=(rows, cols, bands))
+    elif output['interleave'] == 'bil':
+        data = np.memmap(output['data'], dtype=output['dtype'], mode='r+', shape=(rows, bands, cols))
+        data = data.transpose(0, 2, 1)
+    else:
+        data = np.memmap(output['data'], dtype=output['dtype'], mode='r+', shape=(bands, rows, cols))
+        data = data.transpose(1, 2, 0)
+    return data[start:stop]
+
+# Write the header of the image described by output, once all the data
+# has been written, and return the finished image.
+def finishParallelImage(output):
+    tempName = output['header'][:-4] + '-' + str(os.getpid()) + '.hdr'
+    sp.envi.write_envi_header(tempName, output['metadata'])
+    os.replace(tempName, output['header'])
+    return sp.envi.open(output['header'], output['data'])
+
+#
+# Converting lots of files
+#
+
+# The name that a gain adjusted version of file gets by default.
+def gainAdjustedName(file):
+    return file[:-4] + '-gain-adjusted.hdr'
+
+# Find the header files to convert. pattern can be a directory, in
+# which case we take all the .hdr files in it, or a glob pattern like
+# "raw-data-240924/*.hdr". Files that are themselves the result of gain
+# adjustment are left out.
+def findHeaderFiles(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.hdr')
+    files = []
+    for file in sorted(glob.glob(pattern)):
+        if not file.endswith('-gain-adjusted.hdr'):
+            files.append(file)
+    return files
+
+# Check whether outName is an up to date gain adjusted version of file:
+# it has to be newer than both the header and data files of the
+# source, have been adjusted with the gain that the source header now
+# holds, and have been written as outputType with the same scale (see
+# gainMetadata).
+def isGainAdjustedUpToDate(file, outName, outputType='float32', scale=None):
+    if not os.path.isfile(outName):
+        return False
+    image = getImage(file)
+    outTime = os.path.getmtime(outName)
+    if outTime < os.path.getmtime(file) or outTime < os.path.getmtime(image.filename):
+        return False
+    header = sp.envi.read_envi_header(outName)
+    if gainRecordKey not in header:
+        return False
+    recorded = [float(g) for g in header[gainRecordKey]]
+    if recorded != [float(g) for g in image.bands.bandwidths]:
+        return False
+    expected = gainMetadata([], outputType, scale)
+    for key in (gainTypeKey, gainScaleKey):
+        if key in expected and str(header.get(key)) != str(expected[key]):
+            return False
+    return True
+
+# Gain adjust each of files into its default output name, running up to
+# workers conversions at once. Files whose output is already up to date
+# are skipped unless force is True. Each file is streamed, blockRows
+# rows at a time, into an image of type outputType (see
+# streamGainAdjustFile). The only keyword we handle is ext.
+#
+# Returns a list of (file, status, seconds, size) entries, one per
+# file, where status is "converted", "skipped" or "failed: <reason>"
+# and size is the number of bytes of image data.
+def batchGainAdjustFiles(files, workers=1, blockRows=gainBlockRows, outputType='float32', scale=None, force=False, **kwargs):
+    jobs = []
+    for file in files:
+        jobs.append((file, gainAdjustedName(file), blockRows, outputType, scale, force, kwargs))
+
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            return pool.starmap(batchGainAdjustJob, jobs)
+    else:
+        return [batchGainAdjustJob(*job) for job in jobs]
+
+# The job run for each file by batchGainAdjustFiles. Failures are
+# reported rather than raised so that one bad file doesn't stop the
+# rest of the batch.
+def batchGainAdjustJob(file, outName, blockRows, outputType, scale, force, kwargs):
+    start = time.time()
+    try:
+        image = getImage(file)
+        size = imageBytes(image)
+        if not force and isGainAdjustedUpToDate(file, outName, outputType, scale):
+            return (file, 'skipped', time.time() - start, size)
+        streamGainAdjustFile(file, outName, blockRows, outputType, scale, force=True, **kwargs)
+    except Exception as err:
+        return (file, 'failed: ' + str(err), time.time() - start, 0)
+    return (file, 'converted', time.time() - start, size)
+
+# Print a table of the results of batchGainAdjustFiles, with the time
+# taken and throughput for each file.
+def printBatchSummary(results):
+    total = 0
+    for file, status, seconds, size in results:
+        total += seconds
+        if status == 'converted':
+            rate = "%8.1f MB/s" % (size / 1024**2 / max(seconds, 1e-9))
+        else:
+            rate = ""
+        print("%-50s %-10s %8.2f s %s" % (file, status, seconds, rate))
+    print("%d files in %.2f s of processing" % (len(results), total))
+
+#
+# Caching
+#
+
+# Products that take a long time to compute from an image (gain
+# adjusted images, PCA reductions, RGB composites) can be kept in a
+# cache directory so that asking for the same thing again just picks up
+# the earlier result. Each product is stored under a key computed from
+# the contents of the source header, the size and modification time of
+# the source data file, and the name and parameters of the operation,
+# so any change to the source or the parameters gives a new key.
+#
+# The cache lives in $HYPER_CACHE if that is set, otherwise in
+# ~/.cache/hyperspectral. When it grows beyond $HYPER_CACHE_SIZE
+# (default 20G), the least recently used products are deleted.
+cacheDirectory = os.environ.get('HYPER_CACHE',
+                                os.path.join(os.path.expanduser('~'), '.cache', 'hyperspectral'))
+cacheSizeLimit = parseMemorySize(os.environ.get('HYPER_CACHE_SIZE', '20G'))
+
+# The hacked envi.py can also keep parsed headers (and the band
+# information taken from them) in a cache, so that a header is only
+# parsed again if it changes. Unless $SPECTRAL_HEADER_CACHE has already
+# said where that cache goes, we keep it in the headers directory of our
+# cache. It is not counted towards cacheSizeLimit; the entries are tiny.
+if getattr(sp.envi, 'header_cache_dir', False) is None:
+    sp.envi.header_cache_dir = os.path.join(cacheDirectory, 'headers')
+
+# Compute the cache key for the result of applying operation, with the
+# given parameters, to the image with header file.
+def cacheKey(file, operation, *params):
+    key = hashlib.sha256()
+    with open(file, 'rb') as header:
+        key.update(header.read())
+    info = os.stat(getImage(file).filename)
+    key.update(("%d %d" % (info.st_size, info.st_mtime_ns)).encode())
+    key.update(repr((operation,) + params).encode())
+    return key.hexdigest()[:32]
+
+# The name of the cache file with the given key and extension.
+def cachePath(key, ext):
+    return os.path.join(cacheDirectory, key + ext)
+
+# Look for a product in the cache. ext is the extension of the file
+# that is there once the product is complete (".hdr" for images, ".npy"
+# for arrays). Returns the name of that file, or None if the product is
+# not in the cache.
+def cacheLookup(key, ext):
+    path = cachePath(key, ext)
+    if not os.path.isfile(path):
+        return None
+    # Mark the product as recently used.
+    for file in glob.glob(cachePath(key, '.*')):
+        os.utime(file)
+    return path
+
+# The header name to write a new cached image to. The image is written
+# under a temporary name and then given its real name by
+# publishCacheImage, so that a half written image is never found by
+# cacheLookup.
+def newCacheImageName(key):
+    os.makedirs(cacheDirectory, exist_ok=True)
+    return cachePath(key + '-' + str(os.getpid()), '.hdr')
+
+# Move an image written to the header name given by newCacheImageName
+# into place in the cache. Returns the name of the cached header.
+def publishCacheImage(key, name):
+    os.replace(name[:-4] + '.img', cachePath(key, '.img'))
+    os.replace(name, cachePath(key, '.hdr'))
+    trimCache(keep=key)
+    return cachePath(key, '.hdr')
+
+# Delete the least recently used products until the cache is no bigger
+# than limit bytes. The product with key keep, usually the one just
+# added, is never deleted, even if it is bigger than limit on its own.
+def trimCache(limit=None, keep=None):
+    if limit is None:
+        limit = cacheSizeLimit
+    products = {}
+    for file in glob.glob(os.path.join(cacheDirectory, '*')):
+        if not os.path.isfile(file):
+            continue
+        key = os.path.basename(file).split('.')[0]
+        size, used, files = products.get(key, (0, 0, []))
+        info = os.stat(file)
+        products[key] = (size + info.st_size, max(used, info.st_mtime), files + [file])
+
+    total = sum(product[0] for product in products.values())
+    for key, (size, used, files) in sorted(products.items(), key=lambda product: product[1][1]):
+        if total <= limit:
+            break
+        if key == keep:
+            continue
+        for file in files:
+            os.remove(file)
+        total -= size
+
+# Copy a cached image, with header path, to a new image called name.
+# The data file is copied rather than linked: the spectral package
+# rewrites an existing output file in place, so a link would let a later
+# conversion to the same name overwrite the cache entry too. As with
+# outputFile the keywords we handle are ext and force.
+def copyFromCache(path, name, **kwargs):
+    (hdrFile, imgFile) = sp.envi.check_new_filename(name, kwargs.get('ext', '.img'),
+                                                    kwargs.get('force', False))
+    if os.path.exists(imgFile):
+        os.remove(imgFile)
+    shutil.copyfile(path[:-4] + '.img', imgFile)
+    shutil.copyfile(path, hdrFile)
+
+# Get the header name of a cached gain adjusted version of file,
+# creating it with streamGainAdjustFile if it is not already there.
+def cachedGainAdjustedFile(file, blockRows=gainBlockRows, outputType='float32', scale=None):
+    key = cacheKey(file, 'gain', outputType, scale)
+    path = cacheLookup(key, '.hdr')
+    if path is None:
+        name = newCacheImageName(key)
+        streamGainAdjustFile(file, name, blockRows, outputType, scale, force=True)
+        path = publishCacheImage(key, name)
+    return path
+
+# Get an RGB composite of file, as made by sp.get_rgb with the given
+# bands (None lets get_rgb choose), from the cache, creating it if it
+# is not already there. If gain is True, the gain is applied to the
+# image data (see getImage).
+def cachedRGB(file, bands=None, gain=False):
+    key = cacheKey(file, 'rgb', bands, gain)
+    path = cacheLookup(key, '.npy')
+    if path is not None:
+        return np.load(path)
+    rgbImage = sp.get_rgb(getImage(file, gain), bands=bands)
+    os.makedirs(cacheDirectory, exist_ok=True)
+    name = cachePath(key + '-' + str(os.getpid()), '.npy')
+    np.save(name, rgbImage)
+    os.replace(name, cachePath(key, '.npy'))
+    trimCache(keep=key)
+    return rgbImage
+
+#
+# Changing interleave
+#
+
+# The camera writes BIL files, in which each row holds each band in
+# turn. Reading bands is quicker from BSQ files (each band stored in
+# one piece) and reading pixel spectra is quicker from BIP files (each
+# pixel's bands stored together), so it can be worth rewriting an image
+# with a different interleave.
+
+# The name that a version of file with a new interleave gets by
+# default.
+def reinterleavedName(file, interleave):
+    return file[:-4] + '-' + interleave.lower() + '.hdr'
+
+# Rewrite the image in file as a new image called name with the given
+# interleave ("bil", "bip" or "bsq"). Data are copied as they are
+# stored, without applying the gain or scale factor, and all of the
+# header information is kept, except that the new image is always in
+# native byte order. The new image is created with
+# envi.create_image, and blockRows rows are copied at a time from the
+# memmap of the old image to the memmap of the new one, so only one
+# block is ever in memory. As with outputFile the keywords we handle
+# are ext and force.
+def reinterleaveFile(file, name, interleave, blockRows=gainBlockRows, **kwargs):
+    interleave = interleave.lower()
+    if interleave not in ['bil', 'bip', 'bsq']:
+        raise ValueError('Invalid interleave: %s' % str(interleave))
+    image = getImage(file)
+    metadata = image.metadata.copy()
+    for k in ('interleave', 'byte order', 'header offset', 'file type'):
+        metadata.pop(k, None)
+
+    createArgs = {}
+    for k, val in kwargs.items():
+        if k in ('ext', 'force'):
+            createArgs[k] = val
+    newImage = sp.envi.create_image(name, metadata, shape=image.shape,
+                                    dtype=np.dtype(image.dtype).char,
+                                    interleave=interleave, **createArgs)
+
+    # Both memmaps are viewed as rows x columns x bands, whatever
+    # their interleave, so copying rows is just an assignment.
+    data = image.open_memmap(interleave='bip')
+    newData = newImage.open_memmap(interleave='bip', writable=True)
+    for start, stop in rowBlocks(image.shape[0], blockRows):
+        newData[start:stop] = data[start:stop]
+    newData.flush()
+    del newData
+
+    return newImage
+
+# Images from our older camera are big-endian. The spectral package
+# reads them happily, but every read has to swap the bytes of every
+# value. Rewriting such an image once, in native byte order, saves
+# doing that every time the image is used. This replaces the data and
+# header files of the image with ones holding the same values in native
+# order, and returns True, or returns False if the image was already in
+# native order. The data are copied blockRows rows at a time (see
+# reinterleaveFile), into new files that only replace the old ones once
+# they are complete.
+def nativeOrderFile(file, blockRows=gainBlockRows):
+    image = getImage(file)
+    if not image.swap:
+        return False
+    interleave = interleaveNames[image.interleave]
+    ext = os.path.splitext(image.filename)[1]
+    tempName = file[:-4] + '-native-' + str(os.getpid()) + '.hdr'
+    newImage = reinterleaveFile(file, tempName, interleave, blockRows,
+                                ext=ext if ext else '.img', force=True)
+    os.replace(newImage.filename, image.filename)
+    os.replace(tempName, file)
+    return True
+
+#
+# Calibration
+#
+
+# Calibrating an image needs two reference images as well as the raw
+# image: a dark reference (captured with the lens covered) and a white
+# reference (captured from a white calibration surface). Then:
+#
+#  Corrected Image = (Raw - Dark) / (White - Dark)
+#
+# Reference images are usually only a few rows deep, so we collapse
+# each of them to a profile, the average over its rows, which gives one
+# value for every column and band. These are applied to every row of
+# the raw image.
+
+# The name that a calibrated version of file gets by default.
+def calibratedName(file):
+    return file[:-4] + '-calibrated.hdr'
+
+# Collapse a reference image to its columns x bands profile, reading
+# blockRows rows at a time. If gain is True, the gain from the header
+# is applied first.
+def referenceProfile(file, blockRows=gainBlockRows, gain=False):
+    image = getImage(file, gain)
+    total = np.zeros(shape=(image.shape[1], image.shape[2]), dtype='float')
+    for start, stop in rowBlocks(image.shape[0], blockRows):
+        total += np.sum(readRowBlock(image, start, stop), axis=0, dtype='float')
+    return total / image.shape[0]
+
+# Calibrate the raw image in rawFile against the dark and white
+# references in darkFile and whiteFile, writing the result into a new
+# image called name. The references are reduced to profiles once, and
+# then the raw image is read, calibrated and written blockRows rows at
+# a time, so only one block of the raw image is ever in memory.
+#
+# If gain is True, each of the three images has the gain from its own
+# header applied first. (If all three have the same gain, it cancels
+# out, but references are not always captured with the same settings
+# as the image.)
+#
+# The new image holds float32 values in a bip file, with the
+# wavelengths of the raw image. Where the white and dark references
+# are the same, there is nothing to scale by, and the value is set to
+# 0. As with outputFile the keywords we handle are ext and force.
+def calibrateFile(rawFile, darkFile, whiteFile, name, blockRows=gainBlockRows, gain=False, **kwargs):
+    image = getImage(rawFile, gain)
+    dark = referenceProfile(darkFile, blockRows, gain)
+    white = referenceProfile(whiteFile, blockRows, gain)
+    if dark.shape != image.shape[1:] or white.shape != image.shape[1:]:
+        raise ValueError('Reference images must have the same columns and bands as the image')
+    span = white - dark
+
+    metadata = {}
+    if image.bands.centers:
+        metadata['wavelength'] = image.bands.centers
+    if image.bands.band_unit:
+        metadata['wavelength units'] = image.bands.band_unit
+    createArgs = {}
+    for k, val in kwargs.items():
+        if k in ('ext', 'force'):
+            createArgs[k] = val
+    newImage = sp.envi.create_image(name, metadata, shape=image.shape, dtype=np.float32,
+                                    interleave='bip', **createArgs)
+
+    newData = newImage.open_memmap(writable=True)
+    for start, stop in rowBlocks(image.shape[0], blockRows):
+        block = np.subtract(readRowBlock(image, start, stop), dark, dtype='float')
+        newData[start:stop] = np.divide(block, span, out=np.zeros_like(block),
+                                        where=(span != 0))
+    newData.flush()
+    del newData
+
+    return newImage
+
+#
+# Image pyramids
+#
+
+# Showing an RGB image of a big cube means reading every row of three
+# bands, which takes a while, and then most of that detail is thrown
+# away to fit the image in a window. A pyramid is a set of copies of
+# some bands of the image, each half the width and height of the one
+# before (so 2x, 4x, 8x... smaller than the image), where each pixel is
+# the average of the four below it. They are built once, in a single
+# pass over the image, and kept as .npy files in a directory next to
+# the header (<filename>-pyramid). The viewer then only needs to read
+# the smallest copy that still fills the window, and as we zoom in it
+# moves to finer copies, reading just the part that is on screen, and
+# finally to the image itself.
+
+# Levels are added until the longest side is no more than this many
+# pixels.
+pyramidMinSize = 256
+
+# The size (rows, columns) of the window the viewer opens.
+pyramidWindowSize = (768, 1024)
+
+# The directory that holds the pyramids for the image with header file.
+def pyramidDirectory(file):
+    return file[:-4] + '-pyramid'
+
+# The name of the file holding the level of the pyramid for the given
+# bands (and gain) that is factor times smaller than the image.
+def pyramidLevelName(file, bands, gain, factor):
+    name = 'bands-' + '-'.join(str(int(b)) for b in bands)
+    if gain:
+        name += '-gain'
+    return os.path.join(pyramidDirectory(file), name + '-' + str(factor) + 'x.npy')
+
+# The factors by which the levels of a pyramid for an image of the
+# given shape are smaller than the image. An image that is already no
+# bigger than minSize has no levels.
+def pyramidFactors(shape, minSize=pyramidMinSize):
+    factors = []
+    factor = 2
+    while max(shape[0], shape[1]) > minSize * factor // 2:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+# The bands that get_rgb shows when it isn't told which to use: the
+# "default bands" from the header if there are any, otherwise the
+# first, middle and last bands.
+def defaultRGBBands(image):
+    if 'default bands' in image.metadata:
+        try:
+            return [int(b) for b in image.metadata['default bands']]
+        except ValueError:
+            pass
+    n = image.shape[2]
+    return [0, n // 2, n - 1]
+
+# Halve the width and height of a rows x columns x bands block by
+# averaging each 2 x 2 square of pixels. If there is an odd number of
+# rows or columns, the last one is repeated.
+def downsampleBlock(block):
+    if block.shape[0] % 2:
+        block = np.concatenate((block, block[-1:]), axis=0)
+    if block.shape[1] % 2:
+        block = np.concatenate((block, block[:, -1:]), axis=1)
+    total = block[0::2, 0::2] + block[1::2, 0::2] + block[0::2, 1::2] + block[1::2, 1::2]
+    return (total / 4).astype(np.float32)
+
+# Whether the pyramid files names are all there and newer than both the
+# header file and the data file of the image.
+def isPyramidUpToDate(file, image, names):
+    for name in names:
+        if not os.path.exists(name):
+            return False
+        if os.path.getmtime(name) < max(os.path.getmtime(file), os.path.getmtime(image.filename)):
+            return False
+    return True
+
+# Build the pyramid for the given bands of the image with header file,
+# unless there is one already that is up to date (or force is True). If
+# gain is True the gain is applied first. The image is read blockRows
+# rows at a time (rounded to a multiple of the largest factor, so that
+# every block halves cleanly), and each block is shrunk in turn for
+# every level and written into that level's file, so we never hold more
+# than one block of the image. Returns a list of (factor, name) pairs.
+def buildPyramid(file, bands, gain=False, blockRows=gainBlockRows, minSize=pyramidMinSize, force=False):
+    image = getImage(file, gain)
+    bands = [int(b) for b in bands]
+    factors = pyramidFactors(image.shape, minSize)
+    names = [pyramidLevelName(file, bands, gain, f) for f in factors]
+    if factors and (force or not isPyramidUpToDate(file, image, names)):
+        os.makedirs(pyramidDirectory(file), exist_ok=True)
+        step = factors[-1]
+        blockRows = max(step, blockRows // step * step)
+        tempNames = [name[:-4] + '-' + str(os.getpid()) + '.npy' for name in names]
+        levels = []
+        for f, tempName in zip(factors, tempNames):
+            shape = (-(-image.shape[0] // f), -(-image.shape[1] // f), len(bands))
+            levels.append(np.lib.format.open_memmap(tempName, mode='w+', dtype=np.float32, shape=shape))
+        for start, stop in rowBlocks(image.shape[0], blockRows):
+            block = np.asarray(image.read_subregion((start, stop), (0, image.shape[1]), bands), dtype='float')
+            for f, level in zip(factors, levels):
+                block = downsampleBlock(block)
+                level[start // f:start // f + block.shape[0]] = block
+        for level in levels:
+            level.flush()
+        del levels
+        for tempName, name in zip(tempNames, names):
+            os.replace(tempName, name)
+    return list(zip(factors, names))
+
+# The levels of the pyramid for the given bands of the image, building
+# it first if need be, as a dictionary that maps each factor to a
+# rows x columns x bands array. The arrays are memmaps of the pyramid
+# files, so only the parts that are used are read. Factor 1 is the
+# image itself.
+def openPyramid(file, bands, gain=False):
+    levels = {1: getImage(file, gain)}
+    for factor, name in buildPyramid(file, bands, gain):
+        levels[factor] = np.load(name, mmap_mode='r')
+    return levels
+
+# The factor of the coarsest level that still has at least one pixel
+# for each pixel of the window when scale pixels of the image are shown
+# on each pixel of the window.
+def pyramidLevelForScale(factors, scale):
+    best = 1
+    for factor in factors:
+        if factor <= scale and factor > best:
+            best = factor
+    return best
+
+# Read rows and columns (both (start, stop) ranges in pixels of the
+# image) of the given bands from the level of the pyramid that is
+# factor times smaller than the image.
+def readPyramidRegion(levels, factor, bands, rows, cols):
+    if factor == 1:
+        return levels[1].read_subregion(rows, cols, bands)
+    return np.asarray(levels[factor][rows[0] // factor:-(-rows[1] // factor),
+                                     cols[0] // factor:-(-cols[1] // factor)])
+
+# Show an RGB image made from the given bands (None for the bands that
+# get_rgb would pick) using a pyramid. The window starts out showing the
+# whole image from the coarsest level that fills it. Then:
+#
+#  + or =     zooms in
+#  -          zooms out
+#  w a s d    pan up, left, down and right
+#
+# and any other key closes the window. The colour stretch is worked out
+# once, from the coarsest level, so colours don't change as we zoom.
+def showPyramidImage(file, bands=None, gain=False, windowSize=pyramidWindowSize):
+    if bands is None:
+        bands = defaultRGBBands(getImage(file, gain))
+    bands = [int(b) for b in bands]
+    levels = openPyramid(file, bands, gain)
+    image = levels[1]
+    factors = sorted(levels)
+    rows, cols = image.shape[0], image.shape[1]
+
+    coarsest = levels[factors[-1]]
+    if factors[-1] == 1:
+        coarsest = image.read_bands(bands)
+    bounds = get_rgb_meta(np.asarray(coarsest), bands=list(range(len(bands))))[1]['rgb range']
+
+    # The view is given by the pixel of the image at its centre and the
+    # number of image pixels per window pixel.
+    fitScale = max(rows / windowSize[0], cols / windowSize[1])
+    scale = fitScale
+    centre = [rows / 2, cols / 2]
+
+    cv2.namedWindow("main", cv2.WINDOW_NORMAL)
+    cv2.resizeWindow("main", windowSize[1], windowSize[0])
+    while True:
+        halfRows = windowSize[0] * scale / 2
+        halfCols = windowSize[1] * scale / 2
+        centre[0] = min(max(centre[0], min(halfRows, rows / 2)), max(rows - halfRows, rows / 2))
+        centre[1] = min(max(centre[1], min(halfCols, cols / 2)), max(cols - halfCols, cols / 2))
+        viewRows = (max(0, int(centre[0] - halfRows)), min(rows, int(np.ceil(centre[0] + halfRows))))
+        viewCols = (max(0, int(centre[1] - halfCols)), min(cols, int(np.ceil(centre[1] + halfCols))))
+
+        factor = pyramidLevelForScale(factors, scale)
+        region = readPyramidRegion(levels, factor, bands, viewRows, viewCols)
+        rgbImage = sp.get_rgb(region, bands=list(range(len(bands))), bounds=bounds)
+        cv2.imshow('main', rgbImage)
+
+        key = cv2.waitKey(0) & 0xFF
+        if key in (ord('+'), ord('=')):
+            scale = max(scale / 2, 0.25)
+        elif key == ord('-'):
+            scale = min(scale * 2, fitScale)
+        elif key == ord('w'):
+            centre[0] -= halfRows / 2
+        elif key == ord('s'):
+            centre[0] += halfRows / 2
+        elif key == ord('a'):
+            centre[1] -= halfCols / 2
+        elif key == ord('d'):
+            centre[1] += halfCols / 2
+        else:
+            break
+    cv2.destroyAllWindows()
+
+#
+# Planning reads
+#
+
+# How much of a file we have to read to get at part of an image
+# depends on how the file is laid out. In a BIP file each pixel's
+# spectrum is stored in one piece, so reading a few pixels is cheap
+# but reading one band means visiting every pixel. In a BSQ file it is
+# the other way round, and BIL is somewhere in between. The functions
+# here take what an operation needs (a set of pixels, a set of bands,
+# a range of rows) and pick the way of reading it that touches the
+# fewest bytes of the file:
+#
+#  read_pixels    - pick each pixel out of the file (see readPixels).
+#  read_bands     - read whole bands and pick out what is needed.
+#  read_subregion - read the box of rows and columns that holds
+#                   everything that is needed.
+#  scan           - read the same box blockRows rows at a time, so
+#                   only one block is in memory at once.
+#
+# The spectral package reads through the file's memmap, so what a read
+# costs is the number of pages of the file that it touches rather than
+# the number of values it returns. The estimates below count pages,
+# which is rough, but easily good enough to tell a read that needs a
+# few KB from one that needs the whole file.
+
+# The size of a page, in bytes.
+readPageSize = mmap.PAGESIZE
+
+# The order, outermost first, in which the axes (0 = rows, 1 =
+# columns, 2 = bands) are stored for each interleave.
+interleaveAxes = {sp.BIP: (0, 1, 2), sp.BIL: (0, 2, 1), sp.BSQ: (2, 0, 1)}
+interleaveNames = {sp.BIP: 'bip', sp.BIL: 'bil', sp.BSQ: 'bsq'}
+
+# The methods that planRead chooses between. Where two of them would
+# read the same number of bytes, the one earlier in the list is used.
+readMethods = ['read_pixels', 'read_bands', 'read_subregion', 'scan']
+
+# Round a number of bytes up to a whole number of pages.
+def roundToPages(size):
+    return -(-int(size) // readPageSize) * readPageSize
+
+# The size, in bytes, of the data file of an image. Unlike imageBytes
+# this uses the size of the values as they are stored, which is not
+# the same thing for a GainAdjustedImage.
+def fileBytes(image):
+    return int(np.prod(image.shape)) * image.sample_size
+
+# Estimate the number of bytes of the file that have to be read to get
+# the values in rows start to stop-1 (rows is a (start, stop) pair),
+# columns cols (likewise) and the list of band indices bands.
+#
+# Working from the innermost axis outwards, values are stored together
+# for as long as we want every value along an axis. That gives the
+# length of each run of values we read and how many runs there are.
+# Each run costs at least a page, but the total can't be more than the
+# pages between the first and last value we want.
+def boxReadBytes(image, rows, cols, bands):
+    bands = sorted(set(bands))
+    selection = [(rows[0], rows[1], rows[1] - rows[0]),
+                 (cols[0], cols[1], cols[1] - cols[0]),
+                 (bands[0], bands[-1] + 1, len(bands))]
+    order = interleaveAxes[image.interleave]
+
+    run = 1
+    runs = 1
+    together = True
+    for axis in reversed(order):
+        start, stop, count = selection[axis]
+        if together and count == stop - start:
+            run *= count
+            together = (count == image.shape[axis])
+        else:
+            runs *= count
+            together = False
+
+    # Offsets, in values, of the first and last values we want.
+    stride = {order[2]: 1,
+              order[1]: image.shape[order[2]],
+              order[0]: image.shape[order[1]] * image.shape[order[2]]}
+    first = sum(selection[axis][0] * stride[axis] for axis in range(3))
+    last = sum((selection[axis][1] - 1) * stride[axis] for axis in range(3))
+    extent = (last - first + 1) * image.sample_size
+
+    return int(min(runs * roundToPages(run * image.sample_size), roundToPages(extent)))
+
+# The largest number of pixels that readPixels and pixelReadBytes deal
+# with at once.
+pixelChunkSize = 65536
+
+# Estimate the number of bytes of the file that have to be read to get
+# the given bands (None for all of them) at each of pixels (an n x 2
+# array of [row, column] pairs). This counts the distinct pages that
+# hold the values we want, so pixels that share a page are only
+# counted once.
+def pixelReadBytes(image, pixels, bands=None):
+    pixels = np.asarray(pixels, dtype='int').reshape(-1, 2)
+    if bands is None:
+        bands = range(image.shape[2])
+    bands = np.asarray(list(bands), dtype='int')
+    if len(pixels) == 0 or len(bands) == 0:
+        return 0
+
+    # Strides, in values, of the rows, columns and bands (as in
+    # boxReadBytes).
+    order = interleaveAxes[image.interleave]
+    stride = {order[2]: 1,
+              order[1]: image.shape[order[2]],
+              order[0]: image.shape[order[1]] * image.shape[order[2]]}
+    touched = np.zeros(fileBytes(image) // readPageSize + 1, dtype='bool')
+    step = max(1, pixelChunkSize // len(bands))
+    for start in range(0, len(pixels), step):
+        chunk = pixels[start:start + step]
+        offsets = (chunk[:, 0:1] * stride[0] + chunk[:, 1:2] * stride[1] +
+                   bands[np.newaxis, :] * stride[2])
+        touched[offsets * image.sample_size // readPageSize] = True
+    return int(touched.sum()) * readPageSize
+
+# Read the given bands (None for all of them) at each of pixels (an n x
+# 2 array of [row, column] pairs), returning an n x bands float32
+# array, in the same order as pixels.
+#
+# Rather than reading the pixels one at a time, they are sorted into
+# the order they are stored in the file and then picked out of the
+# file's memmap pixelChunkSize at a time with a single index, so the
+# file is read front to back and each page is visited once. Only the
+# bands asked for are picked out, so in a BSQ or BIL file the other
+# bands are never touched. If the file can't be memory mapped we fall
+# back on read_pixel.
+#
+# The wrappers in this file (GainAdjustedImage and InstrumentedImage)
+# have a read_pixels method that does the same thing, and this uses it
+# if it is there.
+def readPixels(image, pixels, bands=None):
+    if hasattr(image, 'read_pixels'):
+        return image.read_pixels(pixels, bands)
+
+    pixels = np.asarray(pixels, dtype='int').reshape(-1, 2)
+    nBands = image.shape[2] if bands is None else len(bands)
+    samples = np.zeros(shape=(len(pixels), nBands), dtype=np.float32)
+    if len(pixels) == 0:
+        return samples
+
+    data = image.open_memmap(interleave='source')
+    if data is None:
+        for n, (row, col) in enumerate(pixels):
+            pixel = image.read_pixel(row, col)
+            samples[n] = pixel if bands is None else pixel[bands]
+        return samples
+
+    # View the memmap as rows x columns x bands, whatever the
+    # interleave, without copying it.
+    data = np.transpose(data, np.argsort(interleaveAxes[image.interleave]))
+    bandIndex = None if bands is None else np.asarray(bands, dtype='int')[np.newaxis, :]
+    order = np.argsort(pixels[:, 0] * image.shape[1] + pixels[:, 1], kind='stable')
+    for start in range(0, len(order), pixelChunkSize):
+        chunk = order[start:start + pixelChunkSize]
+        rows = pixels[chunk, 0]
+        cols = pixels[chunk, 1]
+        if bandIndex is None:
+            values = data[rows, cols]
+        else:
+            values = data[rows[:, np.newaxis], cols[:, np.newaxis], bandIndex]
+        # The memmap holds the values as stored, so divide out the
+        # scale factor as the SpyFile read methods do.
+        if image.scale_factor != 1:
+            values = values / float(image.scale_factor)
+        samples[chunk] = values
+    return samples
+
+# Work out how to read what an operation needs from image (a SpyFile or
+# a GainAdjustedImage):
+#
+#  pixels - a list of [row, column] pairs, or None if the operation
+#           wants every pixel in a range of rows.
+#  bands  - a list of band indices, or None for all of them.
+#  rows   - a (start, stop) range of rows, used when pixels is None.
+#           None means the whole image.
+#
+# The return value is the plan, a dictionary that gives the method to
+# use along with what is needed to carry it out, the estimated number
+# of bytes that method will read ("bytes") and the estimates for every
+# method that could be used ("estimates").
+#
+# If maxMemory is given, methods that would hold more than maxMemory
+# bytes of data (counted as floats) at once are not used, unless none
+# of the methods fit, in which case we scan.
+def planRead(image, pixels=None, bands=None, rows=None, maxMemory=None, blockRows=gainBlockRows):
+    nBands = image.shape[2] if bands is None else len(bands)
+    readBands = list(range(image.shape[2])) if bands is None else bands
+    estimates = {}
+    memory = {}
+
+    if pixels is not None:
+        pixels = np.asarray(pixels, dtype='int').reshape(-1, 2)
+        if len(pixels) == 0:
+            rowBounds = (0, 0)
+            colBounds = (0, 0)
+        else:
+            rowBounds = (int(pixels[:, 0].min()), int(pixels[:, 0].max()) + 1)
+            colBounds = (int(pixels[:, 1].min()), int(pixels[:, 1].max()) + 1)
+        estimates['read_pixels'] = min(pixelReadBytes(image, pixels, readBands), fileBytes(image))
+        memory['read_pixels'] = len(pixels) * nBands * 8
+    else:
+        rowBounds = (0, image.shape[0]) if rows is None else (int(rows[0]), int(rows[1]))
+        colBounds = (0, image.shape[1])
+
+    if pixels is None or len(pixels) > 0:
+        boxRows = rowBounds[1] - rowBounds[0]
+        boxColumns = colBounds[1] - colBounds[0]
+        if bands is not None:
+            estimates['read_bands'] = boxReadBytes(image, (0, image.shape[0]),
+                                                   (0, image.shape[1]), readBands)
+            memory['read_bands'] = image.shape[0] * image.shape[1] * nBands * 8
+        estimates['read_subregion'] = boxReadBytes(image, rowBounds, colBounds, readBands)
+        memory['read_subregion'] = boxRows * boxColumns * nBands * 8
+        if pixels is not None:
+            estimates['scan'] = estimates['read_subregion']
+            memory['scan'] = (min(blockRows, boxRows) * boxColumns + len(pixels)) * nBands * 8
+
+    candidates = [m for m in readMethods if m in estimates]
+    if maxMemory is not None:
+        fits = [m for m in candidates if memory[m] <= maxMemory]
+        if fits:
+            candidates = fits
+        elif 'scan' in candidates:
+            candidates = ['scan']
+    method = min(candidates, key=lambda m: (estimates[m], readMethods.index(m)))
+
+    return {'method': method, 'bytes': estimates[method], 'estimates': estimates,
+            'memory': memory[method], 'fileBytes': fileBytes(image),
+            'interleave': interleaveNames[image.interleave],
+            'pixels': pixels, 'bands': bands, 'rows': rowBounds, 'cols': colBounds,
+            'blockRows': blockRows}
+
+# Carry out a plan from planRead. If the plan is for a set of pixels,
+# this returns a pixels x bands array. Otherwise it returns a rows x
+# columns x bands array.
+def readPlan(image, plan):
+    method = plan['method']
+    pixels = plan['pixels']
+    bands = plan['bands']
+    rowBounds = plan['rows']
+    colBounds = plan['cols']
+
+    if method == 'read_pixels':
+        return readPixels(image, pixels, bands)
+
+    if method == 'read_bands':
+        data = image.read_bands(bands)
+        if pixels is None:
+            return data[rowBounds[0]:rowBounds[1]]
+        return data[pixels[:, 0], pixels[:, 1]]
+
+    if method == 'read_subregion':
+        data = image.read_subregion(rowBounds, colBounds, bands)
+        if pixels is None:
+            return data
+        return data[pixels[:, 0] - rowBounds[0], pixels[:, 1] - colBounds[0]]
+
+    # Scan the box a block of rows at a time, keeping just the pixels
+    # that fall in each block.
+    samples = None
+    for start, stop in rowBlocks(rowBounds[1] - rowBounds[0], plan['blockRows']):
+        start += rowBounds[0]
+        stop += rowBounds[0]
+        block = image.read_subregion((start, stop), colBounds, bands)
+        if samples is None:
+            samples = np.zeros(shape=(len(pixels), block.shape[2]), dtype=block.dtype)
+        inBlock = (pixels[:, 0] >= start) & (pixels[:, 0] < stop)
+        samples[inBlock] = block[pixels[inBlock, 0] - start, pixels[inBlock, 1] - colBounds[0]]
+    return samples
+
+# Print what a plan will do, and how much of the file it expects to
+# read.
+def printPlan(plan):
+    print("Reading %s file with %s: about %.2f MB of %.2f MB" %
+          (plan['interleave'], plan['method'], plan['bytes'] / 1024**2,
+           plan['fileBytes'] / 1024**2))
+    for method in readMethods:
+        if method in plan['estimates']:
+            print("  %-15s %.2f MB" % (method, plan['estimates'][method] / 1024**2))
+
+# Plan a read (see planRead) and carry it out. If report is True, the
+# plan is printed first.
+def plannedRead(image, pixels=None, bands=None, rows=None, maxMemory=None, blockRows=gainBlockRows, report=False):
+    plan = planRead(image, pixels, bands, rows, maxMemory, blockRows)
+    if report:
+        printPlan(plan)
+    return readPlan(image, plan)
+
+#
+# Instrumenting reads
+#
+
+# To see how much of each file a command actually reads, compared with
+# how much of the data it goes on to use, set $HYPER_READ_STATS before
+# running it. getImage then wraps every image it opens in an
+# InstrumentedImage, which counts the calls made to read data, the
+# bytes each call reads from the file (estimated as in planRead), the
+# bytes it hands back, the time spent reading, and which rows and bands
+# were touched. When the command exits the totals for each file are:
+#
+#  - printed, if $HYPER_READ_STATS is set to anything other than the
+#    values below;
+#  - printed as JSON, if it is set to "json";
+#  - written as JSON to the file it names, if it ends in ".json".
+#
+# Reads made through open_memmap (as when converting or re-interleaving
+# an image) can't be seen this way, so only the calls to open_memmap
+# are counted. Nor are reads made by worker processes (convert.py -w).
+readStatsSetting = os.environ.get('HYPER_READ_STATS', '')
+
+# Every InstrumentedImage created, so that we can report on them when
+# the program exits.
+instrumentedImages = []
+
+# An image that passes every read on to the image it wraps, keeping
+# count of what was read. Like GainAdjustedImage, it is a spectral
+# Image, so the spectral package functions accept it, and anything
+# that isn't a read is just passed on.
+class InstrumentedImage(Image):
+
+    def __init__(self, image):
+        params = image.params()
+        self.set_params(params, params.metadata)
+        self.image = image
+        self.shape = image.shape
+        self.filename = image.filename
+        self.interleave = image.interleave
+        self.sample_size = image.sample_size
+        self.calls = {}
+        self.bytesRead = 0
+        self.bytesUsed = 0
+        self.readTime = 0.0
+        self.rowsTouched = set()
+        self.bandsTouched = set()
+        instrumentedImages.append(self)
+
+    def __getattr__(self, name):
+        if name == 'image':
+            raise AttributeError(name)
+        return getattr(self.image, name)
+
+    @property
+    def bands(self):
+        return self.image.bands
+
+    def __str__(self):
+        s = '\tInstrumentedImage, counting reads from:\n\n'
+        s += str(self.image)
+        return s
+
+    # Count a read made by call, which started at time start and
+    # returned data. rows and cols are the (start, stop) ranges that the
+    # read covered, and bands the list of bands (None for all of them).
+    def record(self, call, start, data, rows, cols, bands=None):
+        self.readTime += time.perf_counter() - start
+        self.calls[call] = self.calls.get(call, 0) + 1
+        if bands is None:
+            bands = range(self.shape[2])
+        bands = list(bands)
+        if rows[1] > rows[0] and cols[1] > cols[0] and bands:
+            self.bytesRead += boxReadBytes(self, rows, cols, bands)
+        self.bytesUsed += int(np.size(data)) * self.sample_size
+        self.rowsTouched.update(range(rows[0], rows[1]))
+        self.bandsTouched.update(bands)
+        return data
+
+    def __getitem__(self, args):
+        start = time.perf_counter()
+        data = self.image[args]
+        rows = indexBounds(args[0], self.shape[0])
+        cols = indexBounds(args[1], self.shape[1])
+        bands = None
+        if len(args) > 2 and args[2] is not None:
+            bands = indexList(args[2], self.shape[2])
+        return self.record('__getitem__', start, data, rows, cols, bands)
+
+    def read_band(self, band):
+        start = time.perf_counter()
+        data = self.image.read_band(band)
+        return self.record('read_band', start, data, (0, self.shape[0]),
+                           (0, self.shape[1]), [band])
+
+    def read_bands(self, bands):
+        start = time.perf_counter()
+        data = self.image.read_bands(bands)
+        return self.record('read_bands', start, data, (0, self.shape[0]),
+                           (0, self.shape[1]), bands)
+
+    def read_pixel(self, row, col):
+        start = time.perf_counter()
+        data = self.image.read_pixel(row, col)
+        return self.record('read_pixel', start, data, (row, row + 1), (col, col + 1))
+
+    # The pixels are scattered, so the bytes read are counted with
+    # pixelReadBytes rather than as a box.
+    def read_pixels(self, pixels, bands=None):
+        start = time.perf_counter()
+        data = readPixels(self.image, pixels, bands)
+        self.record('read_pixels', start, data, (0, 0), (0, 0), bands)
+        pixels = np.asarray(pixels, dtype='int').reshape(-1, 2)
+        self.bytesRead += pixelReadBytes(self, pixels, bands)
+        self.rowsTouched.update(pixels[:, 0].tolist())
+        return data
+
+    def read_datum(self, i, j, k):
+        start = time.perf_counter()
+        data = self.image.read_datum(i, j, k)
+        return self.record('read_datum', start, data, (i, i + 1), (j, j + 1), [k])
+
+    def read_subregion(self, row_bounds, col_bounds, bands=None):
+        start = time.perf_counter()
+        data = self.image.read_subregion(row_bounds, col_bounds, bands)
+        return self.record('read_subregion', start, data, row_bounds, col_bounds, bands)
+
+    # The rows and columns need not be next to each other, so we count
+    # this as reading the box that holds them all.
+    def read_subimage(self, rows, cols, bands=None):
+        start = time.perf_counter()
+        data = self.image.read_subimage(rows, cols, bands)
+        return self.record('read_subimage', start, data, (min(rows), max(rows) + 1),
+                           (min(cols), max(cols) + 1), bands)
+
+    def load(self, *args, **kwargs):
+        start = time.perf_counter()
+        data = self.image.load(*args, **kwargs)
+        return self.record('load', start, data, (0, self.shape[0]), (0, self.shape[1]))
+
+    def open_memmap(self, *args, **kwargs):
+        self.calls['open_memmap'] = self.calls.get('open_memmap', 0) + 1
+        return self.image.open_memmap(*args, **kwargs)
+
+# The (start, stop) range of the rows or columns that index picks out
+# of an axis with size entries, where index is an int or a slice.
+def indexBounds(index, size):
+    picked = indexList(index, size)
+    if not picked:
+        return (0, 0)
+    return (min(picked), max(picked) + 1)
+
+# The list of entries that index (an int, a slice or a list) picks out
+# of an axis with size entries.
+def indexList(index, size):
+    if isinstance(index, slice):
+        return list(range(*index.indices(size)))
+    if isinstance(index, (list, tuple, np.ndarray)):
+        return [int(i) % size for i in index]
+    return [int(index) % size]
+
+# Add up the counts for every image opened from each file, since a
+# command may well open the same file more than once.
+def readStats():
+    stats = {}
+    for image in instrumentedImages:
+        entry = stats.setdefault(image.filename, {
+            'file': image.filename, 'shape': list(image.shape),
+            'interleave': interleaveNames[image.interleave],
+            'fileBytes': fileBytes(image), 'calls': {}, 'bytesRead': 0,
+            'bytesUsed': 0, 'readTime': 0.0, 'rows': set(), 'bands': set()})
+        for call, count in image.calls.items():
+            entry['calls'][call] = entry['calls'].get(call, 0) + count
+        entry['bytesRead'] += image.bytesRead
+        entry['bytesUsed'] += image.bytesUsed
+        entry['readTime'] += image.readTime
+        entry['rows'].update(image.rowsTouched)
+        entry['bands'].update(image.bandsTouched)
+
+    result = []
+    for entry in stats.values():
+        entry['rowsTouched'] = len(entry.pop('rows'))
+        entry['bandsTouched'] = len(entry.pop('bands'))
+        if entry['bytesUsed'] > 0:
+            entry['amplification'] = entry['bytesRead'] / entry['bytesUsed']
+        else:
+            entry['amplification'] = None
+        result.append(entry)
+    return result
+
+# Report the read statistics in the way $HYPER_READ_STATS asks for.
+def reportReadStats():
+    stats = readStats()
+    if readStatsSetting.lower() == 'json':
+        print(json.dumps(stats, indent=2))
+    elif readStatsSetting.lower().endswith('.json'):
+        with open(readStatsSetting, 'w') as f:
+            json.dump(stats, f, indent=2)
+    else:
+        for entry in stats:
+            print("Reads from %s (%s, %d x %d x %d):" %
+                  ((entry['file'], entry['interleave']) + tuple(entry['shape'])))
+            calls = ', '.join('%s %d' % (c, n) for c, n in sorted(entry['calls'].items()))
+            print("  calls:     %s" % (calls if calls else 'none'))
+            print("  read:      %.2f MB of %.2f MB in %.3f s" %
+                  (entry['bytesRead'] / 1024**2, entry['fileBytes'] / 1024**2, entry['readTime']))
+            print("  used:      %.2f MB" % (entry['bytesUsed'] / 1024**2))
+            if entry['amplification'] is not None:
+                print("  read/used: %.1f" % entry['amplification'])
+            print("  touched:   %d of %d rows, %d of %d bands" %
+                  (entry['rowsTouched'], entry['shape'][0],
+                   entry['bandsTouched'], entry['shape'][2]))
+
+if readStatsSetting:
+    atexit.register(reportReadStats)
+
+#
+# Stacks of images
+#
+
+# hyper.py works on a grid of images: a set of folders, each holding
+# files with the same names. An ImageStack makes that grid look like a
+# single 5-D array (folder, file, row, column, band) without loading
+# any of it. Each image is opened (header and memmap only) the first
+# time it is used, and indexing the stack reads just the region that
+# is asked for from each image involved. The functions that follow it
+# summarise the images in the stack a block of rows at a time, possibly
+# spreading the blocks over a pool of worker processes, so at most one
+# block per worker is ever in memory.
+class ImageStack:
+
+    def __init__(self, folders, fileNames, gain=False):
+        self.folders = list(folders)
+        self.fileNames = list(fileNames)
+        self.gain = gain
+        self.images = np.empty(shape=(len(self.folders), len(self.fileNames)), dtype='object')
+
+    # The header file of image [i, j] of the grid.
+    def file(self, i, j):
+        return self.folders[i] + '/' + self.fileNames[j]
+
+    # Image [i, j] of the grid, opened if need be (see getImage).
+    def image(self, i, j):
+        if self.images[i, j] is None:
+            self.images[i, j] = getImage(self.file(i, j), self.gain)
+        return self.images[i, j]
+
+    # (folders, files, rows, columns, bands). The images must all have
+    # the same number of rows, columns and bands for this to make sense.
+    @property
+    def shape(self):
+        shapes = set(tuple(self.image(i, j).shape) for i, j in self.indices())
+        if len(shapes) != 1:
+            raise ValueError('Images in the stack do not all have the same shape')
+        return (len(self.folders), len(self.fileNames)) + shapes.pop()
+
+    # All the [i, j] positions in the grid, row by row.
+    def indices(self):
+        return [(i, j) for i in range(len(self.folders)) for j in range(len(self.fileNames))]
+
+    # Index the stack like a 5-D array. The first two indices pick the
+    # images and the rest are applied to each of them (see
+    # readImageRegion). Ints drop that axis from the result, as numpy
+    # does. Unlike numpy, a list of bands picks those bands out of every
+    # pixel and leaves the band axis last, as read_subregion does, even
+    # when other indices are ints.
+    def __getitem__(self, args):
+        if not isinstance(args, tuple):
+            args = (args,)
+        args = args + (slice(None),) * (5 - len(args))
+        folders = indexList(args[0], len(self.folders))
+        files = indexList(args[1], len(self.fileNames))
+        data = np.array([[readImageRegion(self.image(i, j), args[2], args[3], args[4])
+                          for j in files] for i in folders])
+        if not isinstance(args[1], slice):
+            data = data[:, 0]
+        if not isinstance(args[0], slice):
+            data = data[0]
+        return data
+
+    # Go through every image in the stack a block of blockRows rows at a
+    # time, yielding i, j, the first row of the block and the block.
+    def blocks(self, blockRows=gainBlockRows):
+        for i, j in self.indices():
+            image = self.image(i, j)
+            for start, stop in rowBlocks(image.shape[0], blockRows):
+                yield (i, j, start, readRowBlock(image, start, stop))
+
+# Read the part of image picked out by the row, column and band indices
+# (each an int or a slice, and for bands also a list). The bounding box
+# of the rows and columns is read with read_subregion, which goes
+# through the memmap, and then cut down to what was asked for.
+def readImageRegion(image, rows, cols, bands):
+    rowList = indexList(rows, image.shape[0])
+    colList = indexList(cols, image.shape[1])
+    bandList = None
+    if not (isinstance(bands, slice) and bands == slice(None)):
+        bandList = indexList(bands, image.shape[2])
+    if not rowList or not colList:
+        nBands = image.shape[2] if bandList is None else len(bandList)
+        return np.zeros(shape=(len(rowList), len(colList), nBands))
+    rowBounds = (min(rowList), max(rowList) + 1)
+    colBounds = (min(colList), max(colList) + 1)
+    data = image.read_subregion(rowBounds, colBounds, bandList)
+    data = data[np.subtract(rowList, rowBounds[0])][:, np.subtract(colList, colBounds[0])]
+    if not isinstance(bands, (slice, list, tuple, np.ndarray)):
+        data = data[:, :, 0]
+    if not isinstance(cols, slice):
+        data = data[:, 0]
+    if not isinstance(rows, slice):
+        data = data[0]
+    return data
+
+# The sums over rows start to stop-1 of the image in file that we need
+# for its statistics: the number of pixels, the sum of each band and,
+# if covariance is True, the sum of the outer product of each pixel's
+# spectrum with itself. The rows are read blockRows at a time. This is
+# also the job run by each worker in imageStats.
+def rowRangeSums(file, gain, start, stop, blockRows, covariance=True):
+    image = getImage(file, gain)
+    bands = image.shape[2]
+    count = 0
+    total = np.zeros(bands)
+    products = np.zeros(shape=(bands, bands)) if covariance else None
+    for blockStart, blockStop in rowBlocks(stop - start, blockRows):
+        block = readRowBlock(image, start + blockStart, start + blockStop)
+        pixels = np.asarray(block, dtype='float').reshape(-1, bands)
+        count += pixels.shape[0]
+        total += pixels.sum(axis=0)
+        if covariance:
+            products += pixels.T.dot(pixels)
+    return (count, total, products)
+
+# The mean and (if covariance is True) covariance of the bands of the
+# image in file, as a spectral GaussianStats, which
+# sp.principal_components accepts in place of an image. With more than
+# one worker, the rows are split into one range per worker and the
+# sums for each range are worked out in parallel.
+def imageStats(file, gain=False, blockRows=gainBlockRows, workers=1, covariance=True):
+    rows = getImage(file, gain).shape[0]
+    jobs = [(file, gain, start, stop, blockRows, covariance)
+            for start, stop in rowBlocks(rows, -(-rows // max(1, workers)))]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.starmap(rowRangeSums, jobs)
+    else:
+        results = [rowRangeSums(*job) for job in jobs]
+
+    count = sum(r[0] for r in results)
+    mean = sum(r[1] for r in results) / count
+    cov = None
+    if covariance:
+        products = sum(r[2] for r in results)
+        cov = (products - count * np.outer(mean, mean)) / max(count - 1, 1)
+    return sp.GaussianStats(mean=mean, cov=cov, nsamples=count)
+
+# Apply transform (such as the transform member of a spectral
+# PrincipalComponents) to every pixel of image, blockRows rows at a
+# time, writing the result into a new float32 image called name. As
+# with outputFile the keywords we handle are ext and force.
+def transformImageToFile(transform, image, name, blockRows=gainBlockRows, **kwargs):
+    createArgs = {}
+    for k, val in kwargs.items():
+        if k in ('ext', 'force'):
+            createArgs[k] = val
+    newImage = None
+    newData = None
+    for start, stop in rowBlocks(image.shape[0], blockRows):
+        block = transform(readRowBlock(image, start, stop))
+        if newImage is None:
+            shape = (image.shape[0], image.shape[1], block.shape[2])
+            newImage = sp.envi.create_image(name, shape=shape, dtype=np.float32,
+                                            interleave='bip', **createArgs)
+            newData = newImage.open_memmap(writable=True)
+        newData[start:stop] = block
+    newData.flush()
+    del newData
     return newImage
 
 #
@@ -224,44 +1906,403 @@ def parsePointsToPairs(intList):
 # pulls out all the bands. The associated function sampleImageAtBands
 # accepts a list of band indices and just returns those band values
 # for each point.
-def sampleImage(points, file):
-    image = getImage(file)
-    samples = []
+#
+# If gain is True, the gain is applied to the samples (see getImage).
+#
+# The samples are read in whichever way suits the layout of the file
+# (see planRead), which for a scattering of points means picking them
+# all out of the file in one go (see readPixels). The samples come back
+# as a single points x bands float32 array.
+def sampleImage(points, file, gain=False):
+    image = getImage(file, gain)
     # points should be a list of pairs of coordinates:
     #
     # [ [x1, y1], [x2, y2], ...]
     #
     # and at each point we extract all the bands
-    for i in range(len(points)):
-        pointX = points[i][0]
-        pointY = points[i][1]
-        samples.append(image[pointX, pointY])
+    samples = plannedRead(image, pixels=points)
         
-    return samples
+    return np.asarray(samples, dtype=np.float32)
+
+# Extract samples, as above, but just for certain bands. Only those
+# bands are read from the file.
+def sampleImageAtBands(points, bands, file, gain=False):
+    image = getImage(file, gain)
+    samples = plannedRead(image, pixels=points, bands=bands)
+
+    return np.asarray(samples, dtype=np.float32)
+
+#
+# Sampling over windows
+#
+
+# A single pixel is noisy, so rather than the spectrum at a point we
+# may want the mean spectrum over a window x window square of pixels
+# around it (clipped where it runs off the edge of the image). Adding
+# up every window separately costs window x window reads per point, so
+# instead we use a summed-area table: an image I in which I[r, c] is
+# the sum of all the pixels above and to the left of [r, c]. The sum
+# over any box is then
+#
+#  I[bottom, right] - I[top, right] - I[bottom, left] + I[top, left]
+#
+# whatever its size. The table for the whole image would be bigger than
+# the image, so we never hold it. Instead we go down the rows that the
+# windows cover a block at a time, building the rows of the table for
+# each block from the last row of the one before, and pick out the
+# values that the windows with a top or bottom edge in that block need.
+
+# Mean spectra over the window x window squares centred on each of
+# pixels (an n x 2 array of [row, column] pairs), at the given bands
+# (None for all of them), as an n x bands float32 array. Only the rows,
+# columns and bands that the windows cover are read, blockRows rows at
+# a time.
+def sampleWindows(image, pixels, window, bands=None, blockRows=gainBlockRows):
+    pixels = np.asarray(pixels, dtype='int').reshape(-1, 2)
+    nBands = image.shape[2] if bands is None else len(bands)
+    if len(pixels) == 0:
+        return np.zeros(shape=(0, nBands), dtype=np.float32)
+
+    # The edges of each window, as in a slice, and the number of pixels
+    # in it.
+    half = (window - 1) // 2
+    top = np.clip(pixels[:, 0] - half, 0, image.shape[0])
+    bottom = np.clip(pixels[:, 0] - half + window, 0, image.shape[0])
+    left = np.clip(pixels[:, 1] - half, 0, image.shape[1])
+    right = np.clip(pixels[:, 1] - half + window, 0, image.shape[1])
+    counts = (bottom - top) * (right - left)
+
+    # The table is built over the box that holds every window, so it
+    # starts out as zero at the top of the box, and the columns are
+    # counted from the left of the box.
+    rowBounds = (int(top.min()), int(bottom.max()))
+    colBounds = (int(left.min()), int(right.max()))
+    left = left - colBounds[0]
+    right = right - colBounds[0]
+    sums = np.zeros(shape=(len(pixels), nBands))
+    tableRow = np.zeros(shape=(colBounds[1] - colBounds[0] + 1, nBands))
+    tops = np.argsort(top, kind='stable')
+    bottoms = np.argsort(bottom, kind='stable')
+
+    for start, stop in rowBlocks(rowBounds[1] - rowBounds[0], blockRows):
+        start += rowBounds[0]
+        stop += rowBounds[0]
+        block = np.asarray(image.read_subregion((start, stop), colBounds, bands), dtype='float')
+        # Rows start+1 to stop of the table.
+        table = np.zeros(shape=(block.shape[0],) + tableRow.shape)
+        np.cumsum(block, axis=1, out=table[:, 1:])
+        table = tableRow + np.cumsum(table, axis=0)
+        tableRow = table[-1]
+
+        for order, edges, sign in ((tops, top, -1), (bottoms, bottom, 1)):
+            first = np.searchsorted(edges[order], start, side='right')
+            last = np.searchsorted(edges[order], stop, side='right')
+            picked = order[first:last]
+            rows = edges[picked] - start - 1
+            sums[picked] += sign * (table[rows, right[picked]] - table[rows, left[picked]])
+
+    return (sums / np.maximum(counts, 1)[:, np.newaxis]).astype(np.float32)
+
+# Extract the mean spectra over window x window squares centred on
+# points from file (see sampleWindows), at the given bands (None for
+# all of them). If gain is True, the gain is applied to the samples.
+def sampleImageWindows(points, window, file, bands=None, gain=False):
+    image = getImage(file, gain)
+    return sampleWindows(image, points, window, bands)
+
+#
+# Sampling at lots of points
+#
+
+# When there are too many points to type on the command line, they can
+# be read from a file and the samples written to another, a batch of
+# points at a time, so neither the points nor the samples are ever all
+# in memory.
+#
+# A points file is either a .npy file holding an n x 2 array of [row,
+# column] pairs, or a CSV file with a row and a column on each line
+# (a first line that isn't numbers, like "row,column", is skipped).
+#
+# The samples are written in the layout that outputCSVFile uses: the
+# bands on the first line and then the intensities at each point, in
+# the order the points were given. If the output file name ends in
+# .npy, the same thing is written as a float32 array with one more row
+# than there are points.
+
+# The number of points read and sampled at a time, and the most memory
+# each batch of samples may use (see planRead).
+sampleBatchSize = 100000
+sampleMaxMemory = 256 * 1024**2
+
+# Go through the points in file batchSize at a time, yielding each
+# batch as an n x 2 array of ints.
+def pointBatches(file, batchSize=sampleBatchSize):
+    if file.endswith('.npy'):
+        points = np.load(file, mmap_mode='r').reshape(-1, 2)
+        for start in range(0, len(points), batchSize):
+            yield np.asarray(points[start:start + batchSize], dtype='int')
+        return
+
+    with open(file, 'r', newline='') as csvfile:
+        batch = []
+        for n, row in enumerate(csv.reader(csvfile)):
+            if not row:
+                continue
+            try:
+                batch.append([int(row[0]), int(row[1])])
+            except ValueError:
+                if n == 0:
+                    continue
+                raise
+            if len(batch) == batchSize:
+                yield np.array(batch, dtype='int')
+                batch = []
+        if batch:
+            yield np.array(batch, dtype='int')
+
+# The number of points in a points file.
+def countPoints(file):
+    return sum(len(batch) for batch in pointBatches(file))
+
+# The first line of the output for the given bands of image (None for
+# all of them): the band centres if the header has them, otherwise the
+# band numbers counting from 1, as selectPoints does.
+def sampleBandLabels(image, bands=None):
+    if bands is None:
+        bands = range(image.shape[2])
+    centers = image.bands.centers
+    if centers:
+        return [centers[b] for b in bands]
+    return [b + 1 for b in bands]
 
-# Extract samples, as above, but just for certain bands.
-def sampleImageAtBands(points, bands, file):
-    # Get a list of samples each of all the bands
-    listOfFullSamples = sampleImage(points, file)
-    reducedBandList = []
-    for i in range(len(listOfFullSamples)):
-        tempList = []
-        for j in range(len(bands)):
-            tempList.append(listOfFullSamples[i][bands[j]])
+# Sample image at a batch of points, as a points x bands float32
+# array: the pixels themselves, read in the way that suits them (see
+# planRead), or if window is given the means over the windows around
+# them (see sampleWindows).
+def samplePointBatch(image, points, bands=None, window=None):
+    if window:
+        return sampleWindows(image, points, window, bands)
+    samples = plannedRead(image, pixels=points, bands=bands, maxMemory=sampleMaxMemory)
+    return np.asarray(samples, dtype=np.float32)
 
-        reducedBandList.append(tempList)
+# Sample the image in file at every point in pointsFile, at the given
+# bands (None for all of them), writing the samples to outName as they
+# are read (see above). If gain is True, the gain is applied to the
+# samples. Each batch is read in the way that suits it (see planRead),
+# which for a scattering of points means picking them out of the file
+# in one go (see readPixels). If window is given, each sample is the
+# mean over a window x window square around the point instead (see
+# sampleWindows), and each batch makes one pass over the rows its
+# windows cover. If report is True, the number of points done and the
+# rate are printed as we go. Returns the number of points.
+def streamSamples(pointsFile, file, outName, bands=None, gain=False,
+                  batchSize=sampleBatchSize, report=True, window=None):
+    image = getImage(file, gain)
+    labels = sampleBandLabels(image, bands)
+    start = time.time()
+    done = 0
 
-    return reducedBandList
+    if outName.endswith('.npy'):
+        output = np.lib.format.open_memmap(outName, mode='w+', dtype=np.float32,
+                                           shape=(countPoints(pointsFile) + 1, len(labels)))
+        output[0] = labels
+        csvfile = None
+    else:
+        csvfile = open(outName, 'w', newline='')
+        iWriter = csv.writer(csvfile, delimiter=',',
+                             quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        iWriter.writerow(labels)
+
+    try:
+        for batch in pointBatches(pointsFile, batchSize):
+            samples = samplePointBatch(image, batch, bands, window)
+            if csvfile is None:
+                output[done + 1:done + 1 + len(samples)] = samples
+            else:
+                iWriter.writerows(samples.tolist())
+            done += len(samples)
+            if report:
+                rate = done / max(time.time() - start, 1e-9)
+                print("\r%d points, %.0f points/s" % (done, rate), end='', flush=True)
+    finally:
+        if csvfile is None:
+            output.flush()
+            del output
+        else:
+            csvfile.close()
+
+    if report:
+        print("")
+    return done
+
+#
+# Sampling a series of images
+#
+
+# An experiment produces a series of images of the same plants (one
+# folder of images per date, like raw-data-240703 and raw-data-240924),
+# and we want the same points from every one of them. sampleSeries
+# samples each image in a separate job, running up to workers jobs at
+# once, and puts the results together in one file:
+#
+#  - a CSV file in "long" format, with one line per image, point and
+#    band giving the image's header file, the number of the point
+#    (counting from 0, in the order of the points file), the band (as
+#    in sampleBandLabels) and the value;
+#  - or, if the name ends in .npy, a float32 array of shape (images,
+#    points, bands), in the order the files were given.
+#
+# Each job reads the points a batch at a time (see pointBatches) and
+# writes its samples as it goes, straight into its part of the .npy
+# file, or into a CSV file of its own that is added to the output once
+# all the jobs are done, so memory use doesn't grow with the number of
+# points or images.
+
+# The endings that the tools here give to images made from another
+# image (see gainAdjustedName, calibratedName, reinterleavedName and
+# the PCA output of hyper.py).
+derivedImageEndings = ['-gain-adjusted.hdr', '-calibrated.hdr', '-reduced.hdr',
+                       '-bil.hdr', '-bip.hdr', '-bsq.hdr']
+
+# Find the header files of a series. If pattern is a glob pattern, like
+# "raw-data-*/*-gain-adjusted.hdr", we take exactly the files that it
+# matches. If it is a directory, we take the .hdr files in it, less
+# those made from another image in the same directory (one whose name
+# is that image's name plus one of derivedImageEndings), so that a
+# folder of originals and their converted versions gives just the
+# originals. To sample the converted versions, give a pattern.
+def findSeriesFiles(pattern):
+    if not os.path.isdir(pattern):
+        return sorted(glob.glob(pattern))
+    found = sorted(glob.glob(os.path.join(pattern, '*.hdr')))
+    names = set(found)
+    files = []
+    for file in found:
+        derived = False
+        for ending in derivedImageEndings:
+            if file.endswith(ending) and file[:-len(ending)] + '.hdr' in names:
+                derived = True
+        if not derived:
+            files.append(file)
+    return files
+
+# Sample each of files at every point in pointsFile, at the given
+# bands (None for all of them), writing the results to outName (see
+# above). gain and window are as for streamSamples. For a .npy output
+# every image must have the same number of bands as the first.
+#
+# Returns a list of (file, status, seconds, points) entries, one per
+# file, where status is "sampled" or "failed: <reason>". The samples
+# for a file that failed are left out of a CSV output, and are NaN in
+# a .npy one.
+def sampleSeries(pointsFile, files, outName, bands=None, gain=False, window=None, workers=1):
+    if outName.endswith('.npy'):
+        nBands = len(sampleBandLabels(getImage(files[0], gain), bands))
+        output = np.lib.format.open_memmap(outName, mode='w+', dtype=np.float32,
+                                           shape=(len(files), countPoints(pointsFile), nBands))
+        del output
+        partNames = [None] * len(files)
+    else:
+        partNames = [outName + '-' + str(i) + '.part' for i in range(len(files))]
+
+    jobs = []
+    for i, file in enumerate(files):
+        jobs.append((i, file, pointsFile, outName, partNames[i], bands, gain, window))
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.starmap(sampleSeriesJob, jobs)
+    else:
+        results = [sampleSeriesJob(*job) for job in jobs]
+
+    if outName.endswith('.npy'):
+        output = np.load(outName, mmap_mode='r+')
+        for i, result in enumerate(results):
+            if result[1] != 'sampled':
+                output[i] = np.nan
+        output.flush()
+        del output
+    else:
+        with open(outName, 'w', newline='') as csvfile:
+            iWriter = csv.writer(csvfile, delimiter=',',
+                                 quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            iWriter.writerow(['image', 'point', 'band', 'value'])
+            for partName, result in zip(partNames, results):
+                if not os.path.exists(partName):
+                    continue
+                if result[1] == 'sampled':
+                    with open(partName, 'r', newline='') as part:
+                        shutil.copyfileobj(part, csvfile)
+                os.remove(partName)
+    return results
+
+# The job run for each file by sampleSeries. index is the position of
+# file in the series. If partName is None the samples go into the .npy
+# file outName, otherwise into the CSV file partName. As with
+# batchGainAdjustJob, failures are reported rather than raised.
+def sampleSeriesJob(index, file, pointsFile, outName, partName, bands, gain, window):
+    start = time.time()
+    done = 0
+    try:
+        image = getImage(file, gain)
+        labels = sampleBandLabels(image, bands)
+        if partName is None:
+            output = np.load(outName, mmap_mode='r+')
+            if output.shape[2] != len(labels):
+                raise ValueError('Number of bands does not match the first image')
+        else:
+            csvfile = open(partName, 'w', newline='')
+            iWriter = csv.writer(csvfile, delimiter=',',
+                                 quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        try:
+            for batch in pointBatches(pointsFile):
+                samples = samplePointBatch(image, batch, bands, window)
+                if partName is None:
+                    output[index, done:done + len(samples)] = samples
+                else:
+                    # A point at a time, so that we never build lists of
+                    # points x bands entries.
+                    for point, row in enumerate(samples, done):
+                        iWriter.writerows((file, point, label, value)
+                                          for label, value in zip(labels, row.tolist()))
+                done += len(samples)
+        finally:
+            if partName is None:
+                output.flush()
+                del output
+            else:
+                csvfile.close()
+    except Exception as err:
+        return (file, 'failed: ' + str(err), time.time() - start, done)
+    return (file, 'sampled', time.time() - start, done)
+
+# Print a table of the results of sampleSeries, with the time taken and
+# the number of points sampled per second for each file.
+def printSeriesSummary(results):
+    total = 0
+    for file, status, seconds, points in results:
+        total += seconds
+        if status == 'sampled':
+            rate = "%10.0f points/s" % (points / max(seconds, 1e-9))
+        else:
+            rate = ""
+        print("%-50s %-10s %8.2f s %s" % (file, status, seconds, rate))
+    print("%d files in %.2f s of processing" % (len(results), total))
 
 #
 # Picking points from an image
-def selectPoints(file):
+#
+# If gain is True, the gain is applied to the image data (see getImage).
+#
+# Only the three bands that make up the RGB image are read before the
+# window is shown, and the spectrum at each point is read with
+# read_pixel once the points have been picked, so the whole image is
+# never loaded.
+def selectPoints(file, gain=False):
 
-    image = getImage(file)
+    image = getImage(file, gain)
     # Get the wavelengths. If these are missing from the metadata, we
     # will substitute numbers
     bands = image.bands.centers 
-    raw_data = np.array(image.load())
 
     #Get an RGB image which we will use to make our selections on.
     if bands:
@@ -270,12 +2311,13 @@ def selectPoints(file):
         blueBand = locateBandsinImage(bands, 510)
         greenBand = locateBandsinImage(bands, 565)
         redBand = locateBandsinImage(bands, 600)
-        rgbImage = sp.get_rgb(image, bands=(redBand, greenBand, blueBand))
+        rgbBands = [redBand, greenBand, blueBand]
     else:
         # We use default bands based on B=510, G=565.5, R=600. These are
         # not perfect, but are an improvement for my images on the
         # sp.get_rgb default.
-        rgbImage = sp.get_rgb(raw_data, bands=(102, 85, 55))
+        rgbBands = [102, 85, 55]
+    rgbImage = sp.get_rgb(image.read_bands(rgbBands), bands=(0, 1, 2))
 
     # Now view the RGB image, and set our mouse_callback function to
     # record mouse clicks on the image.
@@ -290,7 +2332,12 @@ def selectPoints(file):
     intensities = []
     for click in mouse_clicks:
         (x, y) = click
-        intensities.append(raw_data[x, y])
+        # As the type that load gives: float32 for a SpyFile, and
+        # float for a GainAdjustedImage, which read_pixel gives already.
+        pixel = image.read_pixel(x, y)
+        if not gain:
+            pixel = np.asarray(pixel, dtype=np.float32)
+        intensities.append(pixel)
 
     # If the bands are not in the metadata, we will just number the
     # rows so that the plotting code has what it expects.
@@ -32,6 +32,9 @@ def displayHelp():
     print("1) python viewer.py -h or python viewer.py --Help, which displays this message.")
     print("2) python viewer.py -b band1 band2 band3 <filename>, or python viewer.py --Bands  band1 band2 band3 <filename> ")
     print("3) python viewer.py -d <filename>, or python viewer.py --Default <filename> ")
+    print("Adding -g or --Gain applies the gain values in the header to the image data as it is read, so there is no need to run convert.py first.")
+    print("Adding -k or --Cache keeps the RGB image in a cache directory (see utils.py) so that it can be shown straight away next time.")
+    print("Adding -p or --Pyramid shows the image using a pyramid of smaller copies (built the first time, see pyramid.py), so that even huge images appear straight away. Press + or - to zoom in and out, w, a, s and d to move around, and any other key to close the window.")
     print("<filename> should be a hyperspectral image header file, and bands should be the indices of the red, green and blue bands within the hyperspectral image. This data can be found in the header file (or see the bands.py utility).")
 
 #
@@ -44,29 +47,48 @@ def main():
     # Defining options. Note that the way that bands are passed is not
     # pretty (and doesn't specify that the options take values, but
     # allows for multiple values to be simply called).
-    options = "hbd:"
+    options = "hbgkpd:"
 
     # Long options
-    long_options = ["Help", "Bands", "Default="]
+    long_options = ["Help", "Bands", "Gain", "Cache", "Pyramid", "Default="]
 
     try:
         # Parsing argument
         arguments, values = getopt.getopt(argList, options, long_options)
 
+        # Gain, cache and pyramid have to be known before any image
+        # is displayed, so look for them first.
+        gain = False
+        cache = False
+        pyramid = False
+        for currentArgument, currentValue in arguments:
+            if currentArgument in ("-g", "--Gain"):
+                gain = True
+            elif currentArgument in ("-k", "--Cache"):
+                cache = True
+            elif currentArgument in ("-p", "--Pyramid"):
+                pyramid = True
+
         # checking each argument
         for currentArgument, currentValue in arguments:
             if currentArgument in ("-h", "--Help"):
                 displayHelp()
                 
             elif currentArgument in ("-d", "--Default"):
-                utils.showDefaultRGBImage(currentValue)
+                if pyramid:
+                    utils.showPyramidImage(currentValue, None, gain)
+                else:
+                    utils.showDefaultRGBImage(currentValue, gain, cache)
              
             elif currentArgument in ("-b", "--Bands"):
                 # Passing the relevant values to the function that
                 # does all the work. 
                 bands = values[0:3]
                 print("Bands = ", bands)
-                utils.showRGBImage(argList[-1], bands)
+                if pyramid:
+                    utils.showPyramidImage(argList[-1], bands, gain)
+                else:
+                    utils.showRGBImage(argList[-1], bands, gain, cache)
                 
                 
     except getopt.error as err: